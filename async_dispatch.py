@@ -0,0 +1,83 @@
+import asyncio
+from concurrent.futures import Executor
+from functools import partial
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from uuid import UUID
+
+from driver import Driver
+from offer import Offer, OfferManager
+from trip import Trip
+
+
+class OfferEvent(NamedTuple):
+    added: List[Offer]
+    removed: List[UUID]
+
+
+# asyncio front end of OfferManager. Every connected driver session reads
+# offer deltas from its own queue. Everything that touches OfferManager or
+# searches routes runs in the executor, so the event loop never waits for
+# a route search or for the manager lock. Claims stay atomic there.
+# Must be created inside a running event loop.
+class AsyncDispatcher:
+    def __init__(self, executor: Optional[Executor] = None):
+        self.__loop = asyncio.get_running_loop()
+        self.__executor = executor
+        self.__queues: Dict[UUID, asyncio.Queue] = {}
+        OfferManager().dispatcher = self
+
+    def close(self):
+        if OfferManager().dispatcher is self:
+            OfferManager().dispatcher = None
+        self.__queues.clear()
+
+    def connect(self, driver: Driver) -> asyncio.Queue:
+        queue = self.__queues.get(driver.id)
+        if queue is None:
+            queue = self.__queues[driver.id] = asyncio.Queue()
+            offers = driver.available_offers
+            if offers:
+                queue.put_nowait(OfferEvent(offers, []))
+        return queue
+
+    def disconnect(self, driver: Driver):
+        self.__queues.pop(driver.id, None)
+
+    async def next_event(self, driver: Driver) -> OfferEvent:
+        return await self.connect(driver).get()
+
+    # Called by OfferManager from any thread
+    def publish(self, driver: Driver, added: List[Offer], removed: List[UUID]):
+        queue = self.__queues.get(driver.id)
+        if queue is not None:
+            self.__loop.call_soon_threadsafe(queue.put_nowait,
+                                             OfferEvent(list(added), list(removed)))
+
+    async def add_offer(self, offer: Offer) -> bool:
+        return await self.__run(OfferManager().add_offer, offer)
+
+    async def del_offer(self, _id: UUID) -> bool:
+        return await self.__run(OfferManager().del_offer_by_id, _id)
+
+    # With a driver, see OfferManager.claim_offer
+    async def claim_offer(self, _id: UUID, driver: Optional[Driver] = None) -> Optional[Offer]:
+        return await self.__run(OfferManager().claim_offer, _id, driver)
+
+    async def get_ready(self, driver: Driver):
+        await self.__run(driver.get_ready)
+
+    async def go_sleep(self, driver: Driver):
+        await self.__run(driver.go_sleep)
+
+    async def move(self, driver: Driver, location):
+        await self.__run(setattr, driver, 'location', location)
+
+    async def handle_offer(self, driver: Driver, offer_id: UUID) -> Optional[Trip]:
+        return await self.__run(driver.accept_offer, offer_id)
+
+    # Trip for an offer that was already claimed for the driver
+    async def create_trip(self, driver: Driver, offer: Offer) -> Trip:
+        return await self.__run(driver.start_trip, offer)
+
+    async def __run(self, function: Callable, *args: Any) -> Any:
+        return await self.__loop.run_in_executor(self.__executor, partial(function, *args))
@@ -0,0 +1,179 @@
+import asyncio
+import random
+from abc import ABC, abstractmethod
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+from uuid import UUID
+
+import metrics
+from ledger import Charge, Ledger
+from payment import HANDLERS, CashPayHandler, PaymentHandler, PaymentHandlerType
+from trip import PaymentState, Trip, TripManager
+from user import UserManager
+
+GATEWAY_FAILURES = metrics.registry.counter('payment_gateway_failures',
+                                            'Gateway calls that timed out or failed')
+
+
+# Transient failure of a provider, the step is retried
+class GatewayError(Exception):
+    pass
+
+
+# Connection to a payment provider. reference identifies the trip, so a
+# provider can tell a retried charge from a new one.
+class GatewayConnection(ABC):
+    # True if the amount was taken, False if it was declined
+    @abstractmethod
+    async def charge(self, passenger_id: UUID, amount: int,
+                     reference: Optional[UUID]) -> bool:
+        pass
+
+    def close(self):
+        pass
+
+
+class PaymentGateway(ABC):
+    @abstractmethod
+    async def connect(self) -> GatewayConnection:
+        pass
+
+
+# In-process stand-in for a provider: takes the money from the Ledger
+# balance of its method. latency and failure_rate imitate the network.
+class LocalGateway(PaymentGateway):
+    def __init__(self, method: PaymentHandlerType, latency: float = 0.0,
+                 failure_rate: float = 0.0, seed: Optional[int] = None):
+        self.method = method
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+
+    async def connect(self) -> GatewayConnection:
+        return LocalConnection(self)
+
+
+class LocalConnection(GatewayConnection):
+    def __init__(self, gateway: LocalGateway):
+        self.gateway = gateway
+
+    async def charge(self, passenger_id: UUID, amount: int,
+                     reference: Optional[UUID]) -> bool:
+        if self.gateway.latency:
+            await asyncio.sleep(self.gateway.latency)
+        if self.gateway.random.random() < self.gateway.failure_rate:
+            raise GatewayError(f'{self.gateway.method.name} is not available')
+        charge = Charge(passenger_id, amount, (self.gateway.method,), reference)
+        return Ledger().settle([charge])[0] is not None
+
+
+# At most size charges at once through a gateway. Idle connections are
+# reused, a connection that failed, timed out or was cancelled is closed.
+# timeout limits the charge itself, not the wait for a free connection.
+class ConnectionPool:
+    def __init__(self, gateway: PaymentGateway, size: int = 8):
+        if size <= 0:
+            raise ValueError('size should be positive')
+        self.gateway = gateway
+        self.size = size
+        self.opened = 0
+        self.__slots = asyncio.Semaphore(size)
+        self.__idle: List[GatewayConnection] = []
+
+    async def charge(self, passenger_id: UUID, amount: int,
+                     reference: Optional[UUID], timeout: Optional[float] = None) -> bool:
+        async with self.__slots:
+            if self.__idle:
+                connection = self.__idle.pop()
+            else:
+                connection = await self.gateway.connect()
+                self.opened += 1
+            try:
+                charged = await asyncio.wait_for(
+                    connection.charge(passenger_id, amount, reference), timeout)
+            except BaseException:
+                self.opened -= 1
+                connection.close()
+                raise
+            self.__idle.append(connection)
+            return charged
+
+    def close(self):
+        while self.__idle:
+            self.__idle.pop().close()
+            self.opened -= 1
+
+
+# asyncio counterpart of PaymentHandler.handle: every cashless step of the
+# chain is a call to the gateway of its method. A step that times out or
+# keeps failing after retries falls through to the next one, like a
+# declined one; cash is the last resort. Only the gateway calls are
+# awaited. A paid trip is finished on the loop, without threads touching
+# the managers: a status change, a reindex and, with an archive set, one
+# append to its log. Must be created inside a running event loop.
+class AsyncPaymentPipeline:
+    def __init__(self, gateways: Dict[PaymentHandlerType, PaymentGateway],
+                 pool_size: int = 8, timeout: float = 2.0, retries: int = 2,
+                 backoff: float = 0.05):
+        if timeout <= 0:
+            raise ValueError('timeout should be positive')
+        if retries < 0:
+            raise ValueError('retries should not be negative')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pools = {method: ConnectionPool(gateway, pool_size)
+                      for method, gateway in gateways.items()}
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+    async def pay(self, handler: PaymentHandler, price: Decimal,
+                  reference: Optional[UUID] = None) -> str:
+        charge = handler.charge(price, reference)
+        for method in charge.methods:
+            pool = self.pools.get(method)
+            if pool is not None and await self.__step(method, pool, charge):
+                return HANDLERS[method].message
+        return CashPayHandler.message
+
+    # Pays for the trip and finishes it like PaymentState.next_state does.
+    # The trip is claimed before the first await, so it is paid only once
+    # however many completions of it run, see TripManager.claim_payment.
+    async def complete_trip(self, trip: Trip) -> str:
+        if not TripManager().claim_payment(trip):
+            raise ValueError('Trip should be waiting for payment and not being paid for')
+        return await self.__complete(trip)
+
+    # Trips that don't wait for payment or are being paid for elsewhere are
+    # skipped. Returns the messages in the order of the trips paid.
+    async def complete_trips(self, trips: Iterable[Trip]) -> List[str]:
+        claimed = [trip for trip in trips if TripManager().claim_payment(trip)]
+        return list(await asyncio.gather(*(self.__complete(trip) for trip in claimed)))
+
+    async def __complete(self, trip: Trip) -> str:
+        try:
+            message = await self.pay(trip.payment_handler, trip.price, trip.id)
+            driver = UserManager().find_driver_by_id(trip.driver_id)
+            PaymentState.paid(trip, driver)
+            return message
+        finally:
+            TripManager().release_payment(trip)
+
+    async def __step(self, method: PaymentHandlerType, pool: ConnectionPool,
+                     charge: Charge) -> bool:
+        for attempt in range(self.retries + 1):
+            try:
+                return await pool.charge(charge.passenger_id, charge.amount,
+                                         charge.reference, self.timeout)
+            except asyncio.TimeoutError:
+                if metrics.enabled:
+                    GATEWAY_FAILURES.inc(1, metrics.labels(method=method.name, reason='timeout'))
+                return False
+            except GatewayError:
+                if metrics.enabled:
+                    GATEWAY_FAILURES.inc(1, metrics.labels(method=method.name, reason='error'))
+                if attempt < self.retries:
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+        return False
@@ -0,0 +1,59 @@
+import argparse
+import random
+import time
+from typing import Any, Callable, List
+from uuid import uuid4
+
+from manager import EntityStore, Manager
+
+
+class Entity:
+    def __init__(self):
+        self.id = uuid4()
+
+
+# Microseconds per call of operation over elements
+def per_call(operation: Callable[[Any], Any], elements: List[Any]) -> float:
+    started = time.perf_counter()
+    for element in elements:
+        operation(element)
+    return (time.perf_counter() - started) / len(elements) * 10 ** 6
+
+
+def run(size: int, operations: int, seed: int):
+    rng = random.Random(seed)
+    entities = [Entity() for _ in range(size)]
+    probes = rng.sample(entities, operations)
+    extra = [Entity() for _ in range(operations)]
+
+    lst = list(entities)
+    store = EntityStore()
+    started = time.perf_counter()
+    for entity in entities:
+        store.add(entity)
+    fill = time.perf_counter() - started
+
+    results = {
+        'list': (per_call(lambda e: Manager.find_by_id(lst, e.id), probes),
+                 per_call(lambda e: Manager.add_element(lst, e), extra),
+                 per_call(lambda e: Manager.del_by_id(lst, e.id), probes)),
+        'store': (per_call(lambda e: Manager.find_by_id(store, e.id), probes),
+                  per_call(lambda e: Manager.add_element(store, e), extra),
+                  per_call(lambda e: Manager.del_by_id(store, e.id), probes)),
+    }
+
+    print(f'{size} entities, store filled in {fill:.2f} s, us per call:')
+    print(f'{"":>6} {"find":>10} {"add":>10} {"delete":>10}')
+    for name, (find, add, delete) in results.items():
+        print(f'{name:>6} {find:>10.2f} {add:>10.2f} {delete:>10.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare list scans with EntityStore')
+    parser.add_argument('sizes', type=int, nargs='*', default=[10 ** 5, 10 ** 6])
+    parser.add_argument('--operations', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        run(size, args.operations, args.seed)
@@ -0,0 +1,108 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import Dict, List, Tuple
+from uuid import uuid4
+
+from bench_routing import generate_map
+from map import Location, Map
+from matching import Edge, assign, greedy
+from spatial_index import GridIndex
+
+
+class Point:
+    def __init__(self, location: Location):
+        self.id = uuid4()
+        self.location = location
+
+
+# (cost, offer, driver) for every driver closer than max_dist to an offer,
+# the same one-to-many searches OfferManager.match_batch runs
+def pickup_edges(offers: List[Point], drivers: List[Point], max_dist: float) -> List[Edge]:
+    index = GridIndex()
+    column: Dict = {}
+    for j, driver in enumerate(drivers):
+        index.update(driver, driver.location)
+        column[driver.id] = j
+
+    edges = []
+    for i, offer in enumerate(offers):
+        candidates = index.within(offer.location, max_dist - 1)
+        distances = Map().distances_to(offer.location,
+                                       [driver.location for driver in candidates], max_dist)
+        edges.extend((distances[driver.location], i, column[driver.id])
+                     for driver in candidates if driver.location in distances)
+    return edges
+
+
+# Current behaviour: drivers in random order take the first offer of their
+# list that is still open
+def first_come(edges: List[Edge], drivers: int, seed: int) -> List[Tuple[int, int]]:
+    available: Dict[int, List[int]] = {}
+    for _, offer, driver in sorted(edges, key=lambda edge: edge[1]):
+        available.setdefault(driver, []).append(offer)
+    order = list(range(drivers))
+    random.Random(seed).shuffle(order)
+
+    taken = set()
+    pairs = []
+    for driver in order:
+        for offer in available.get(driver, ()):
+            if offer not in taken:
+                taken.add(offer)
+                pairs.append((offer, driver))
+                break
+    return pairs
+
+
+def run(size: int, max_dist: float, exact_limit: int, seed: int):
+    rng = random.Random(seed)
+    free = [Location(x, y) for x in range(Map().height) for y in range(Map().width)
+            if Map()[x][y] != -1]
+    offers = [Point(rng.choice(free)) for _ in range(size)]
+    drivers = [Point(rng.choice(free)) for _ in range(size)]
+
+    started = time.perf_counter()
+    edges = pickup_edges(offers, drivers, max_dist)
+    searches = time.perf_counter() - started
+    cost = {(offer, driver): value for value, offer, driver in edges}
+
+    print(f'{size} offers x {size} drivers, {len(edges)} pairs in range, '
+          f'searches {searches:.2f} s')
+    print(f'{"method":>12} {"time, s":>10} {"matched":>8} {"pickup":>10} {"per trip":>9}')
+    methods = {
+        'first come': lambda: first_come(edges, size, seed),
+        'greedy': lambda: greedy(edges),
+        'assignment': lambda: assign(edges, size, size, exact_limit),
+    }
+    for name, method in methods.items():
+        started = time.perf_counter()
+        pairs = method()
+        elapsed = time.perf_counter() - started
+        total = sum(cost[pair] for pair in pairs)
+        if name == 'assignment' and size > exact_limit:
+            name = 'assign/greedy'
+        print(f'{name:>12} {elapsed:>10.3f} {len(pairs):>8} {total:>10} '
+              f'{total / max(len(pairs), 1):>9.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare batch matching with first come first served')
+    parser.add_argument('sizes', type=int, nargs='*', default=[100, 1000, 5000])
+    parser.add_argument('--map-size', type=int, default=150)
+    parser.add_argument('--obstacles', type=float, default=0.2)
+    parser.add_argument('--max-dist', type=float, default=30)
+    parser.add_argument('--exact-limit', type=int, default=300,
+                        help='largest batch solved by the Hungarian algorithm')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'map.txt')
+        generate_map(file_name, args.map_size, args.map_size, args.obstacles, args.seed)
+        random.seed(args.seed)
+        Map(file_name)
+        for size in args.sizes:
+            run(size, args.max_dist, args.exact_limit, args.seed)
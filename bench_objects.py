@@ -0,0 +1,131 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List, Tuple
+
+import map as map_module
+from bench_routing import generate_map, random_queries
+from map import Location, Map
+from offer import Offer
+from report import Report
+from trip import Trip
+
+
+# Location as it was before: a dict-backed object hashed through strings
+class LegacyLocation:
+    def __init__(self, x: int, y: int):
+        self.x = x
+        self.y = y
+
+    def __eq__(self, other):
+        return self.x == other.x and self.y == other.y
+
+    def __hash__(self):
+        return int(str(hash(self.x)) + str(hash(self.y)))
+
+
+# Any dict-backed object, like Offer, Trip and Report were
+class Plain:
+    pass
+
+
+# Bytes allocated per object by make, the field values are shared
+def bytes_per_object(make: Callable[[], object], count: int) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [make() for _ in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del objects
+    return used / count
+
+
+def filled(cls: type, fields: dict) -> Callable[[], object]:
+    def make():
+        element = cls.__new__(cls)
+        for name, value in fields.items():
+            setattr(element, name, value)
+        return element
+
+    return make
+
+
+def memory(count: int):
+    offer_fields = {name: None for name in Offer.__slots__}
+    trip_fields = {name: None for name in Trip.__slots__}
+    report_fields = {name: None for name in Report.__slots__}
+
+    print(f'{"object":>10} {"before, B":>10} {"after, B":>10}')
+    rows = [
+        ('Location', lambda: LegacyLocation(1, 2), lambda: Location(1, 2)),
+        ('Offer', filled(Plain, offer_fields), filled(Offer, offer_fields)),
+        ('Trip', filled(Plain, trip_fields), filled(Trip, trip_fields)),
+        ('Report', filled(Plain, report_fields), filled(Report, report_fields)),
+    ]
+    for name, before, after in rows:
+        print(f'{name:>10} {bytes_per_object(before, count):>10.1f} '
+              f'{bytes_per_object(after, count):>10.1f}')
+
+
+def timed(function: Callable[[], object]) -> float:
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+
+def hashing(location_type: type, cells: List[Tuple[int, int]]) -> float:
+    locations = [location_type(x, y) for x, y in cells]
+    probes = [location_type(x, y) for x, y in cells]
+
+    def run():
+        index = {location: i for i, location in enumerate(locations)}
+        for location in probes:
+            _ = index[location]
+
+    return timed(run)
+
+
+# Today's route and one-to-many searches with map.Location swapped for
+# location_type. Only the cost of the value type is isolated, the search
+# algorithm is the current one for both: this is not the old pathfinding.
+def pathfinding(location_type: type, pairs: List[Tuple[Location, Location]]) -> Tuple[float, float]:
+    pairs = [(location_type(*start), location_type(*end)) for start, end in pairs]
+    map_module.Location = location_type
+    try:
+        routes = timed(lambda: [Map().search_way(start, end) for start, end in pairs])
+        targets = [end for _, end in pairs]
+        searches = timed(lambda: [Map().distances_from(start, targets) for start, _ in pairs[:10]])
+    finally:
+        map_module.Location = Location
+    return routes, searches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory and speed of the core value types')
+    parser.add_argument('--objects', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=200, help='side of a random map')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'map.txt')
+        generate_map(file_name, args.size, args.size, 0.3, args.seed)
+        random.seed(args.seed)
+        Map(file_name)
+
+    memory(args.objects)
+
+    cells = [(x, y) for x in range(Map().height) for y in range(Map().width)]
+    pairs = random_queries(Map(), args.queries, args.seed)
+    print(f'\n{"Location":>20} {"before, s":>10} {"after, s":>10}')
+    print(f'{"dict of all cells":>20} {hashing(LegacyLocation, cells):>10.3f} '
+          f'{hashing(Location, cells):>10.3f}')
+    legacy = pathfinding(LegacyLocation, pairs)
+    current = pathfinding(Location, pairs)
+    print(f'\n{"current search with":>20} {"legacy, s":>10} {"Location, s":>11}')
+    print(f'{"search_way":>20} {legacy[0]:>10.3f} {current[0]:>11.3f}')
+    print(f'{"distances_from":>20} {legacy[1]:>10.3f} {current[1]:>11.3f}')
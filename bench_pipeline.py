@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    import resource
+except ImportError:  # not on Windows, peak memory is not reported then
+    resource = None
+
+import metrics
+from bench_routing import generate_map
+from car import Car, Model
+from driver import Driver, Status
+from lifecycle import LifecycleEngine, SimulatedClock
+from map import Location, Map
+from offer import OfferDirector, OfferManager, OfferRequest
+from passenger import Passenger
+from payment import PaymentHandlerType
+from trip import FinishedState, Trip
+from user import UserManager
+
+PAYMENT_TYPES = list(PaymentHandlerType)
+
+
+def percentiles(values: Sequence[float]) -> Dict[str, Optional[float]]:
+    ordered = sorted(values)
+
+    def rank(share: float) -> Optional[float]:
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+    return {'p50': rank(0.5), 'p90': rank(0.9), 'p99': rank(0.99)}
+
+
+def peak_memory_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Simulation of a city: passengers arrive at arrival_rate per minute and
+# ask for a ride, ready drivers take the offers pushed to them, trips go
+# through the state machine on a simulated clock and are paid.
+class Simulation:
+    def __init__(self, drivers: int, passengers: int, arrival_rate: float,
+                 offer_ttl: int, resync_every: int, seed: int):
+        self.arrival_rate = arrival_rate
+        self.offer_ttl = timedelta(minutes=offer_ttl)
+        self.resync_every = resync_every
+        self.random = random.Random(seed)
+        self.clock = SimulatedClock(datetime(2020, 1, 1))
+        self.engine = LifecycleEngine(self.clock)
+
+        city_map = Map()
+        self.free = [Location(x, y) for x in range(city_map.height)
+                     for y in range(city_map.width) if city_map[x][y] != -1]
+
+        self.drivers: List[Driver] = []
+        for i in range(drivers):
+            driver = Driver(f'driver{i}', 'password', Car(Model.HYUNDAI_SOLARIS, f'A{i}'))
+            driver.location = self.random.choice(self.free)
+            UserManager().add_user(driver)
+            driver.get_ready()
+            self.drivers.append(driver)
+
+        self.idle: List[Passenger] = []
+        for i in range(passengers):
+            passenger = Passenger(f'passenger{i}', 'password')
+            UserManager().add_user(passenger)
+            passenger.google_pay_balance = Decimal(self.random.randint(0, 500))
+            passenger.bank_card_balance = Decimal(self.random.randint(0, 500))
+            self.idle.append(passenger)
+
+        self.pending: Dict = {}  # offer id -> (offer, creation time)
+        self.riding: Dict = {}  # trip id -> (trip, driver, passenger, destination)
+
+        self.offers = 0
+        self.trips = 0
+        self.finished = 0
+        self.expired = 0
+        self.dispatch_wait: List[float] = []
+        self.timings: Dict[str, List[float]] = {'make_offers': [], 'add_offer': [],
+                                                'notify_observers': [], 'handle_offer': [],
+                                                'tick': []}
+
+    def run(self, minutes: int):
+        for minute in range(minutes):
+            self.arrivals()
+            if self.resync_every and minute % self.resync_every == 0:
+                self.timed('notify_observers', OfferManager().notify_observers)
+            self.dispatch()
+            self.expire()
+            self.timed('tick', self.engine.tick)
+            self.release()
+            self.clock.advance(timedelta(minutes=1))
+
+    def timed(self, name: str, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        self.timings[name].append((time.perf_counter() - started) * 1000)
+        return result
+
+    # Poisson arrivals of idle passengers, priced in one bulk call
+    def arrivals(self):
+        count, elapsed = 0, self.random.expovariate(self.arrival_rate)
+        while elapsed < 1 and count < len(self.idle):
+            count += 1
+            elapsed += self.random.expovariate(self.arrival_rate)
+        if not count:
+            return
+
+        requests = []
+        for _ in range(count):
+            passenger = self.idle.pop(self.random.randrange(len(self.idle)))
+            passenger.location = self.random.choice(self.free)
+            requests.append(OfferRequest(passenger, self.random.choice(self.free),
+                                         payment_type=self.random.choice(PAYMENT_TYPES)))
+        offers = self.timed('make_offers', OfferDirector().make_offers, requests)
+
+        for request, offer in zip(requests, offers):
+            if offer is None:
+                self.idle.append(request.passenger)
+                continue
+            self.offers += 1
+            self.pending[offer.id] = (offer, self.clock())
+            self.timed('add_offer', OfferManager().add_offer, offer)
+
+    # Every ready driver with offers takes one of them
+    def dispatch(self):
+        drivers = [driver for driver in self.drivers
+                   if driver.status == Status.READY and driver.available_offers]
+        self.random.shuffle(drivers)
+        for driver in drivers:
+            offers = driver.available_offers
+            if not offers:
+                continue
+            trip: Optional[Trip] = self.timed('handle_offer', driver.handle_offer,
+                                              self.random.randrange(len(offers)))
+            if trip is None:
+                continue
+            offer, created = self.pending.pop(trip.offer_id)
+            self.dispatch_wait.append((self.clock() - created).total_seconds())
+            self.riding[trip.id] = (trip, driver, offer.passenger, offer.destination_point)
+            self.trips += 1
+
+    def expire(self):
+        for _id, (offer, created) in list(self.pending.items()):
+            if self.clock() - created >= self.offer_ttl:
+                OfferManager().del_offer_by_id(_id)
+                del self.pending[_id]
+                self.idle.append(offer.passenger)
+                self.expired += 1
+
+    # Drivers of finished trips wait for the next offer at the destination
+    def release(self):
+        for _id, (trip, driver, passenger, destination) in list(self.riding.items()):
+            if isinstance(trip.state, FinishedState):
+                del self.riding[_id]
+                driver.location = destination
+                self.idle.append(passenger)
+                self.finished += 1
+
+
+def run(args) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'map.txt')
+        generate_map(file_name, args.map_size, args.map_size, args.obstacles, args.seed)
+        random.seed(args.seed)
+        Map(file_name)
+
+    simulation = Simulation(args.drivers, args.passengers, args.arrival_rate,
+                            args.offer_ttl, args.resync_every, args.seed)
+    searches = Map().search_count
+    started = time.perf_counter()
+    simulation.run(args.minutes)
+    elapsed = time.perf_counter() - started
+    searches = Map().search_count - searches
+
+    return {
+        'commit': git_commit(),
+        'config': vars(args),
+        'results': {
+            'wall_s': elapsed,
+            'offers': simulation.offers,
+            'trips': simulation.trips,
+            'finished_trips': simulation.finished,
+            'expired_offers': simulation.expired,
+            'offers_per_s': simulation.offers / elapsed,
+            'trips_per_s': simulation.trips / elapsed,
+            'route_searches_per_trip': searches / simulation.trips if simulation.trips else None,
+            'dispatch_wait_s': percentiles(simulation.dispatch_wait),
+            'latency_ms': {name: percentiles(values)
+                           for name, values in simulation.timings.items()},
+            'peak_memory_mb': peak_memory_mb(),
+        },
+    }
+
+
+# Flat name -> value of every number in the results
+def flatten(results: dict, prefix: str = '') -> Dict[str, float]:
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{name}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + name] = value
+    return flat
+
+
+def compare(report: dict, baseline: dict) -> List[Tuple[str, float, float, Optional[float]]]:
+    current, previous = flatten(report['results']), flatten(baseline['results'])
+    return [(name, previous[name], value,
+             (value - previous[name]) / previous[name] * 100 if previous[name] else None)
+            for name, value in current.items() if name in previous]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End to end load test: offers, dispatch, '
+                                                 'trips and payments on a simulated clock')
+    parser.add_argument('--drivers', type=int, default=200)
+    parser.add_argument('--passengers', type=int, default=1000)
+    parser.add_argument('--arrival-rate', type=float, default=50,
+                        help='passengers asking for a ride per simulated minute')
+    parser.add_argument('--minutes', type=int, default=120, help='simulated minutes')
+    parser.add_argument('--offer-ttl', type=int, default=5,
+                        help='minutes an offer waits for a driver')
+    parser.add_argument('--resync-every', type=int, default=10,
+                        help='minutes between full notify_observers resyncs, 0 - never')
+    parser.add_argument('--map-size', type=int, default=40)
+    parser.add_argument('--obstacles', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--metrics', help='collect metrics and write them in Prometheus '
+                                          'text format to this file')
+    parser.add_argument('--profile', help='dump cProfile stats of the run to this file')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable()
+    if args.profile:
+        with metrics.profile(args.profile):
+            report = run(args)
+    else:
+        report = run(args)
+    if args.metrics:
+        metrics.registry.write_prometheus(args.metrics)
+    print(json.dumps(report['results'], indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        print(f'\ncompared with {baseline.get("commit")}')
+        for name, before, after, change in compare(report, baseline):
+            change_text = f'{change:+.1f}%' if change is not None else '-'
+            print(f'{name:>40} {before:>12.3f} {after:>12.3f} {change_text:>9}')
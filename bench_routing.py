@@ -0,0 +1,99 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import List, Tuple
+
+from map import Location, Map
+
+HEURISTICS = ('dijkstra', 'manhattan', 'landmarks')
+
+
+# Random map in the map.txt format: 0 - can pass, -1 - can't pass
+def generate_map(file_name: str, height: int, width: int, obstacles: float, seed: int):
+    rng = random.Random(seed)
+    with open(file_name, 'w') as file:
+        for _ in range(height):
+            file.write(' '.join('-1' if rng.random() < obstacles else '0'
+                                for _ in range(width)) + '\n')
+
+
+def random_queries(city_map, count: int, seed: int) -> List[Tuple[Location, Location]]:
+    rng = random.Random(seed)
+    free = [Location(x, y) for x in range(city_map.height) for y in range(city_map.width)
+            if city_map[x][y] != -1]
+    return [(rng.choice(free), rng.choice(free)) for _ in range(count)]
+
+
+def run(map_file: str, queries: int, landmark_count: int, seed: int, processes: int = 0):
+    city_map = Map(map_file)
+    random.seed(seed)
+    city_map.update_traffic()
+
+    started = time.perf_counter()
+    city_map.build_landmarks(landmark_count)
+    print(f'map {city_map.height}x{city_map.width}, '
+          f'{landmark_count} landmarks built in {time.perf_counter() - started:.2f} s')
+
+    pairs = random_queries(city_map, queries, seed)
+    costs = {}
+    print(f'{"heuristic":>10} {"ms/query":>10} {"expanded":>10}')
+    for heuristic in HEURISTICS:
+        expanded = 0
+        costs[heuristic] = []
+        started = time.perf_counter()
+        for start, end in pairs:
+            route, cells = city_map.search_way(start, end, heuristic)
+            expanded += cells
+            costs[heuristic].append(sum(city_map.traffic(cell) for cell in route[1:]))
+        elapsed = time.perf_counter() - started
+        print(f'{heuristic:>10} {elapsed / queries * 1000:>10.3f} {expanded / queries:>10.1f}')
+
+    if len({tuple(value) for value in costs.values()}) != 1:
+        raise RuntimeError('Heuristics found routes of different cost')
+
+    if processes:
+        run_pool(city_map, pairs, processes)
+
+
+# The same batch through find_way in this process and through RoutingPool
+def run_pool(city_map, pairs: List[Tuple[Location, Location]], processes: int):
+    from parallel_routing import RoutingPool
+
+    city_map.route_cache.clear()
+    started = time.perf_counter()
+    serial = [len(city_map.find_way(start, end)) for start, end in pairs]
+    elapsed = time.perf_counter() - started
+    print(f'{"find_way":>10} {elapsed / len(pairs) * 1000:>10.3f}')
+
+    with RoutingPool(processes) as pool:
+        city_map.route_cache.clear()
+        started = time.perf_counter()
+        parallel = pool.distances(pairs)
+        elapsed = time.perf_counter() - started
+    print(f'{f"{processes} procs":>10} {elapsed / len(pairs) * 1000:>10.3f}')
+
+    if parallel != serial:
+        raise RuntimeError('RoutingPool found routes of different length')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare Dijkstra, A* and ALT on a city map')
+    parser.add_argument('--map', help='map file in the map.txt format, random if omitted')
+    parser.add_argument('--size', type=int, default=200, help='side of a random map')
+    parser.add_argument('--obstacles', type=float, default=0.3, help='share of -1 cells')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--landmarks', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=0,
+                        help='also time the batch on a RoutingPool of that many processes')
+    args = parser.parse_args()
+
+    if args.map:
+        run(args.map, args.queries, args.landmarks, args.seed, args.processes)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'map.txt')
+            generate_map(file_name, args.size, args.size, args.obstacles, args.seed)
+            run(file_name, args.queries, args.landmarks, args.seed, args.processes)
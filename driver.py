@@ -1,10 +1,16 @@
+from __future__ import annotations
+
 import enum
-from typing import List, Optional
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+from uuid import UUID
 
 from car import Car
-from offer import Offer, OfferManager
-from trip import TripManager, Trip
-from user import User
+from user import User, UserManager
+
+# offer and trip import this module, so they are imported where used
+if TYPE_CHECKING:
+    from offer import Offer
+    from trip import Trip
 
 
 class Status(enum.Enum):
@@ -17,22 +23,61 @@ class Driver(User):
     def __init__(self, login: str, password: str, car: Car):
         super().__init__(login, password)
         self.car = car
-        self.status: Status = Status.OFFLINE
-        self.__available_offers: List[Offer] = []
+        self.__status: Status = Status.OFFLINE
+        self.__available_offers: Dict[UUID, Offer] = {}
+        from offer import OfferManager
         OfferManager().add_observer(self)
 
-    def update(self, offer_list: List[Offer]):
-        self.__available_offers = offer_list
+    @property
+    def status(self) -> Status:
+        return self.__status
+
+    # Drivers are indexed by status in UserManager and, when ready,
+    # by location in OfferManager
+    @status.setter
+    def status(self, value: Status):
+        if value != self.__status:
+            self.__status = value
+            UserManager().update_user(self)
+            from offer import OfferManager
+            OfferManager().update_driver(self)
+
+    def _location_changed(self):
+        from offer import OfferManager
+        OfferManager().update_driver(self)
+
+    @property
+    def available_offers(self) -> List[Offer]:
+        return list(self.__available_offers.values())
+
+    # OfferManager pushes new offers in range and retracts gone ones
+    def update(self, added: Iterable[Offer] = (), removed: Iterable[UUID] = ()):
+        for _id in removed:
+            self.__available_offers.pop(_id, None)
+        for offer in added:
+            self.__available_offers[offer.id] = offer
 
     def handle_offer(self, offer_index: int) -> Optional[Trip]:
-        offer = self.__available_offers[offer_index]
-        if OfferManager().find_offer_by_id(offer.id) is not None:
-            self.status = Status.ON_ROUTE
-            OfferManager().del_offer_by_id(offer.id)
-            trip = Trip(self, offer)
-            TripManager().add_trip(trip)
-            return trip
-        return None
+        return self.accept_offer(self.available_offers[offer_index].id)
+
+    # Only one of the drivers accepting the same offer gets a trip, and a
+    # driver gets one trip at a time
+    def accept_offer(self, offer_id: UUID) -> Optional[Trip]:
+        from offer import OfferManager
+        if offer_id not in self.__available_offers:
+            return None
+        offer = OfferManager().claim_offer(offer_id, self)
+        if offer is None:
+            return None
+        return self.start_trip(offer)
+
+    # Trip for an offer already claimed for this driver
+    def start_trip(self, offer: Offer) -> Trip:
+        from trip import Trip, TripManager
+        self.status = Status.ON_ROUTE
+        trip = Trip(self, offer)
+        TripManager().add_trip(trip)
+        return trip
 
     def get_ready(self):
         if self.status != Status.ON_ROUTE:
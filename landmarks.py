@@ -0,0 +1,107 @@
+from array import array
+from heapq import heappop, heappush
+from random import Random
+from typing import Callable, List, Sequence
+
+INF = int(10 ** 10)
+
+
+# Plain Dijkstra over a flat grid (x * width + y), returns the traffic cost
+# of the best way from origin to every cell, or from every cell to origin
+# if reverse is set. Unreachable cells get INF.
+def traffic_costs(cells: Sequence[int], height: int, width: int,
+                  origin: int, reverse: bool = False) -> array:
+    distance = array('q', [INF]) * (height * width)
+    distance[origin] = 0
+    heap = [(0, origin)]
+
+    while heap:
+        dist, point = heappop(heap)
+        if dist > distance[point]:
+            continue
+        traffic = cells[point]
+        if reverse and traffic == -1:
+            continue
+
+        x, y = divmod(point, width)
+        for xx, yy in ((x - 1, y), (x, y - 1), (x + 1, y), (x, y + 1)):
+            if not (0 <= xx < height and 0 <= yy < width):
+                continue
+            cell = xx * width + yy
+            if reverse:
+                new_dist = dist + traffic
+            elif cells[cell] == -1:
+                continue
+            else:
+                new_dist = dist + cells[cell]
+            if new_dist < distance[cell]:
+                distance[cell] = new_dist
+                heappush(heap, (new_dist, cell))
+
+    return distance
+
+
+# ALT preprocessing: exact traffic costs from and to a few landmarks give
+# lower bounds of any way by the triangle inequality
+class Landmarks:
+    def __init__(self, cells: Sequence[int], height: int, width: int,
+                 count: int = 8, seed: int = 0):
+        if count <= 0:
+            raise ValueError('count should be positive')
+        self.height = height
+        self.width = width
+        self.landmarks: List[int] = []
+        self.forward: List[array] = []  # landmark -> cell
+        self.backward: List[array] = []  # cell -> landmark
+
+        free = [index for index in range(height * width) if cells[index] != -1]
+        if not free:
+            return
+
+        # Farthest point selection: every next landmark is the cell farthest
+        # from the ones already chosen
+        nearest = array('q', [INF]) * (height * width)
+        landmark = Random(seed).choice(free)
+        while len(self.landmarks) < min(count, len(free)):
+            self.landmarks.append(landmark)
+            self.forward.append(traffic_costs(cells, height, width, landmark))
+            self.backward.append(traffic_costs(cells, height, width, landmark, reverse=True))
+
+            for index in free:
+                cost = self.forward[-1][index]
+                if cost < nearest[index]:
+                    nearest[index] = cost
+            candidates = [index for index in free
+                          if nearest[index] != INF and index not in self.landmarks]
+            if not candidates:
+                break
+            landmark = max(candidates, key=lambda index: nearest[index])
+
+    def __len__(self):
+        return len(self.landmarks)
+
+    # Lower bound of the traffic cost from a cell to target
+    def heuristic_to(self, target: int) -> Callable[[int], int]:
+        tables = [(forward, forward[target], backward, backward[target])
+                  for forward, backward in zip(self.forward, self.backward)]
+
+        def heuristic(cell: int) -> int:
+            bound = 0
+            for forward, to_target, backward, from_target in tables:
+                if to_target != INF and forward[cell] != INF:
+                    bound = max(bound, to_target - forward[cell])
+                if backward[cell] != INF and from_target != INF:
+                    bound = max(bound, backward[cell] - from_target)
+            return bound
+
+        return heuristic
+
+    # Lower bound of the traffic cost from source to target
+    def lower_bound(self, source: int, target: int) -> int:
+        bound = 0
+        for forward, backward in zip(self.forward, self.backward):
+            if forward[target] != INF and forward[source] != INF:
+                bound = max(bound, forward[target] - forward[source])
+            if backward[source] != INF and backward[target] != INF:
+                bound = max(bound, backward[source] - backward[target])
+        return bound
@@ -0,0 +1,169 @@
+import json
+import os
+from collections import deque
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
+from threading import Lock
+from typing import Deque, Dict, Hashable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from uuid import UUID
+
+import metrics
+from manager import singleton
+
+CENT = Decimal('0.01')
+# Entries Ledger.journal keeps in memory
+JOURNAL_SIZE = 10000
+
+SETTLED = metrics.registry.counter('payments_settled', 'Charges by the method that paid them')
+FALL_THROUGHS = metrics.registry.counter('payment_fall_throughs',
+                                         'Methods of a charge that had too little money')
+
+
+def to_cents(amount: Decimal) -> int:
+    return int(Decimal(amount).quantize(CENT, rounding=ROUND_HALF_UP) * 100)
+
+
+def from_cents(amount: int) -> Decimal:
+    return Decimal(amount) * CENT
+
+
+def _name(method: Hashable) -> str:
+    return getattr(method, 'name', str(method))
+
+
+# Change of one balance, in minor units: negative for debits
+class JournalEntry(NamedTuple):
+    passenger_id: UUID
+    method: Hashable
+    amount: int
+    reference: Optional[UUID]
+    time: datetime
+
+    def encode(self) -> bytes:
+        return json.dumps([str(self.passenger_id), _name(self.method), self.amount,
+                           str(self.reference) if self.reference else None,
+                           self.time.isoformat()], separators=(',', ':')).encode() + b'\n'
+
+    # The method comes back as its name
+    @staticmethod
+    def decode(line: bytes) -> 'JournalEntry':
+        passenger_id, method, amount, reference, time = json.loads(line)
+        return JournalEntry(UUID(passenger_id), method, amount,
+                            UUID(reference) if reference else None,
+                            datetime.fromisoformat(time))
+
+
+# Append-only file of journal entries, one JSON line each. The entries of
+# one ledger call are written at once.
+class JournalLog:
+    def __init__(self, file_name: str, fsync: bool = False):
+        self.file_name = file_name
+        self.fsync = fsync
+        self.__file = open(file_name, 'ab')
+
+    def close(self):
+        self.__file.close()
+
+    def write(self, entries: List[JournalEntry]):
+        self.__file.write(b''.join(entry.encode() for entry in entries))
+        self.__file.flush()
+        if self.fsync:
+            os.fsync(self.__file.fileno())
+
+    # The whole history, oldest first. A line cut off by a crash is skipped.
+    def __iter__(self) -> Iterator[JournalEntry]:
+        with open(self.file_name, 'rb') as file:
+            for line in file:
+                if line.endswith(b'\n'):
+                    yield JournalEntry.decode(line)
+
+
+# Amount to take from the first of methods holding enough of it
+class Charge(NamedTuple):
+    passenger_id: UUID
+    amount: int
+    methods: Tuple[Hashable, ...]
+    reference: Optional[UUID] = None
+
+
+# Balances per (passenger, payment method) in integer minor units. Every
+# change is recorded in the journal, which keeps the latest JOURNAL_SIZE
+# entries. With journal_log set, all of them are written to it as well.
+@singleton
+class Ledger:
+    def __init__(self):
+        self.journal: Deque[JournalEntry] = deque(maxlen=JOURNAL_SIZE)
+        self.journal_log: Optional[JournalLog] = None
+        self.__balances: Dict[Tuple[UUID, Hashable], int] = {}
+        self.__written: List[JournalEntry] = []
+        self.__lock = Lock()
+
+    def balance(self, passenger_id: UUID, method: Hashable) -> int:
+        return self.__balances.get((passenger_id, method), 0)
+
+    def deposit(self, passenger_id: UUID, method: Hashable, amount: int,
+                reference: Optional[UUID] = None):
+        if amount < 0:
+            raise ValueError('Deposit should not be negative')
+        with self.__lock:
+            self.__change(passenger_id, method, amount, reference, datetime.now())
+            self.__write()
+
+    def set_balance(self, passenger_id: UUID, method: Hashable, amount: int):
+        if amount < 0:
+            raise ValueError('Balance should not be negative')
+        with self.__lock:
+            self.__change(passenger_id, method, amount - self.balance(passenger_id, method),
+                          None, datetime.now())
+            self.__write()
+
+    # All charges in one pass under the lock. For every charge returns the
+    # method that paid it, None if none of its methods had enough.
+    def settle(self, charges: Iterable[Charge]) -> List[Optional[Hashable]]:
+        charges = list(charges)
+        for charge in charges:
+            if charge.amount < 0:
+                raise ValueError('Charge should not be negative')
+
+        paid_by: List[Optional[Hashable]] = []
+        balances = self.__balances
+        with self.__lock:
+            now = datetime.now()
+            for passenger_id, amount, methods, reference in charges:
+                for method in methods:
+                    if balances.get((passenger_id, method), 0) >= amount:
+                        self.__change(passenger_id, method, -amount, reference, now)
+                        paid_by.append(method)
+                        break
+                else:
+                    paid_by.append(None)
+            self.__write()
+        if metrics.enabled:
+            self.__record(charges, paid_by)
+        return paid_by
+
+    @staticmethod
+    def __record(charges: List[Charge], paid_by: List[Optional[Hashable]]):
+        for charge, method in zip(charges, paid_by):
+            declined = charge.methods if method is None \
+                else charge.methods[:charge.methods.index(method)]
+            for fallen in declined:
+                FALL_THROUGHS.inc(1, metrics.labels(method=_name(fallen)))
+            SETTLED.inc(1, metrics.labels(method=_name(method) if method is not None else 'none'))
+
+    def __change(self, passenger_id: UUID, method: Hashable, amount: int,
+                 reference: Optional[UUID], time: datetime):
+        if amount == 0:
+            return
+        key = (passenger_id, method)
+        self.__balances[key] = self.__balances.get(key, 0) + amount
+        entry = JournalEntry(passenger_id, method, amount, reference, time)
+        self.journal.append(entry)
+        if self.journal_log is not None:
+            self.__written.append(entry)
+
+    def __write(self):
+        entries, self.__written = self.__written, []
+        log = self.journal_log
+        if entries and log is not None:
+            log.write(entries)
@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+from typing import Callable, NamedTuple, Optional
+
+from trip import PaymentState, RidingState, TripManager, WaitingState
+
+
+# Clock for simulations: stands still until advanced
+class SimulatedClock:
+    def __init__(self, start: Optional[datetime] = None):
+        self.now = start if start is not None else datetime.now()
+
+    def __call__(self) -> datetime:
+        return self.now
+
+    def advance(self, delta: timedelta) -> datetime:
+        self.now += delta
+        return self.now
+
+
+class TickStats(NamedTuple):
+    time: datetime
+    picked_up: int
+    arrived: int
+    paid: int
+
+
+# Moves every trip of TripManager on by at most one state per tick:
+#   waiting -> riding  after wait_time, the wait fee is charged,
+#   riding  -> payment once the estimated trip time has passed,
+#   payment -> finished, all trips of the tick settled in one ledger pass.
+# Trips are taken from the state index of TripManager, so a tick doesn't
+# look at trips that have nothing to do. clock replaces TripManager().clock
+# for trips and their states.
+class LifecycleEngine:
+    def __init__(self, clock: Optional[Callable[[], datetime]] = None,
+                 wait_time: timedelta = timedelta(minutes=3)):
+        if clock is not None:
+            TripManager().clock = clock
+        self.wait_time = wait_time
+
+    def tick(self) -> TickStats:
+        manager = TripManager()
+        now = manager.clock()
+        # Every group is taken before any trip moves
+        waiting = manager.trips_in_state(WaitingState)
+        riding = manager.trips_in_state(RidingState)
+        paying = manager.trips_in_state(PaymentState)
+
+        picked_up = 0
+        pickup_before = now - self.wait_time
+        for trip in waiting:
+            if trip.departure_time <= pickup_before:
+                trip.state.pick_up(trip, now)
+                picked_up += 1
+
+        arrived = 0
+        durations = {}
+        for trip in riding:
+            estimated = trip.estimated_trip_time
+            duration = durations.get(estimated)
+            if duration is None:
+                duration = durations[estimated] = timedelta(
+                    hours=estimated.hour, minutes=estimated.minute, seconds=estimated.second)
+            if trip.pickup_time + duration <= now:
+                trip.state.arrive(trip, now)
+                arrived += 1
+
+        # Trips paid for elsewhere or with a user gone are not counted
+        paid = len(manager.settle_trips(paying))
+        return TickStats(now, picked_up, arrived, paid)
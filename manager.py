@@ -1,6 +1,19 @@
-from typing import List, Optional, Any
+from itertools import islice
+from threading import RLock
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Tuple, Union
 from uuid import UUID
 
+import metrics
+
+LOOKUPS = metrics.registry.counter('manager_lookups',
+                                   'Manager operations and index lookups by container')
+LIST_SCANS = metrics.registry.histogram('manager_list_scan_length',
+                                        'Elements a Manager operation walked in a plain list')
+STORE = {operation: metrics.labels(operation=operation, container='store')
+         for operation in ('find', 'delete', 'add', 'find_by')}
+LIST = {operation: metrics.labels(operation=operation, container='list')
+        for operation in ('find', 'delete', 'add')}
+
 
 # Decorator for a singleton
 def singleton(cls):
@@ -14,26 +27,160 @@ def singleton(cls):
     return getinstance
 
 
-@singleton
+# Elements with an id, stored by id in insertion order. Secondary indexes
+# map a key computed from an element to the elements having it.
+# Changes are serialized by a lock, lookups don't take it.
+class EntityStore:
+    def __init__(self):
+        self.__lock = RLock()
+        self.__elements: Dict[UUID, Any] = {}
+        # name -> (key function, unique, key -> {id: element}, id -> key)
+        self.__indexes: Dict[str, Tuple[Callable[[Any], Hashable], bool,
+                                        Dict[Hashable, Dict[UUID, Any]],
+                                        Dict[UUID, Hashable]]] = {}
+
+    def __len__(self):
+        return len(self.__elements)
+
+    # Iterates over a copy of the elements taken at the call. The store may
+    # change meanwhile, such changes are not seen by the iteration.
+    def __iter__(self) -> Iterator[Any]:
+        return iter(list(self.__elements.values()))
+
+    def __contains__(self, element: Any) -> bool:
+        return getattr(element, 'id', None) in self.__elements
+
+    def find(self, _id: UUID) -> Optional[Any]:
+        return self.__elements.get(_id)
+
+    def add(self, element: Any) -> bool:
+        with self.__lock:
+            if element.id in self.__elements:
+                return False
+            for name, (key, unique, entries, _) in self.__indexes.items():
+                if unique and entries.get(key(element)):
+                    raise ValueError(f'{name} {key(element)} is already used')
+            self.__elements[element.id] = element
+            for name in self.__indexes:
+                self.__index(name, element)
+            return True
+
+    def delete(self, _id: UUID) -> bool:
+        with self.__lock:
+            element = self.__elements.pop(_id, None)
+            if element is None:
+                return False
+            for name in self.__indexes:
+                self.__unindex(name, _id)
+            return True
+
+    # Find and delete in one step, only one of concurrent callers gets it
+    def pop(self, _id: UUID) -> Optional[Any]:
+        with self.__lock:
+            element = self.__elements.get(_id)
+            if element is not None:
+                self.delete(_id)
+            return element
+
+    def add_index(self, name: str, key: Callable[[Any], Hashable], unique: bool = False):
+        with self.__lock:
+            if name in self.__indexes:
+                raise ValueError(f'Index {name} already exists')
+            self.__indexes[name] = (key, unique, {}, {})
+            for element in self.__elements.values():
+                self.__index(name, element)
+
+    # Elements with key(element) == value in insertion order, the first
+    # limit of them if it is set
+    def find_by(self, name: str, value: Hashable, limit: Optional[int] = None) -> List[Any]:
+        if metrics.enabled:
+            LOOKUPS.inc(1, STORE['find_by'])
+        return list(islice(self.__indexes[name][2].get(value, {}).values(), limit))
+
+    def find_one_by(self, name: str, value: Hashable) -> Optional[Any]:
+        if metrics.enabled:
+            LOOKUPS.inc(1, STORE['find_by'])
+        entries = self.__indexes[name][2].get(value)
+        return next(iter(entries.values())) if entries else None
+
+    def count_by(self, name: str, value: Hashable) -> int:
+        return len(self.__indexes[name][2].get(value, ()))
+
+    # Must be called after a change of an element that moves it between keys
+    def reindex(self, element: Any):
+        with self.__lock:
+            if element.id not in self.__elements:
+                return
+            for name, (key, unique, entries, keys) in self.__indexes.items():
+                new_key = key(element)
+                if keys[element.id] == new_key:
+                    continue
+                if unique and entries.get(new_key):
+                    raise ValueError(f'{name} {new_key} is already used')
+                self.__unindex(name, element.id)
+                self.__index(name, element)
+
+    def __index(self, name: str, element: Any):
+        key, unique, entries, keys = self.__indexes[name]
+        value = key(element)
+        if unique and entries.get(value):
+            raise ValueError(f'{name} {value} is already used')
+        entries.setdefault(value, {})[element.id] = element
+        keys[element.id] = value
+
+    def __unindex(self, name: str, _id: UUID):
+        _, _, entries, keys = self.__indexes[name]
+        value = keys.pop(_id)
+        bucket = entries[value]
+        del bucket[_id]
+        if not bucket:
+            del entries[value]
+
+
+# Only static helpers, so not a singleton: Manager.add_element(...) must
+# reach the class itself. Works on plain lists and, in O(1), on EntityStore.
 class Manager:
     @staticmethod
-    def del_by_id(lst: List[Any], _id: UUID) -> bool:
+    def del_by_id(lst: Union[List[Any], EntityStore], _id: UUID) -> bool:
+        if isinstance(lst, EntityStore):
+            if metrics.enabled:
+                LOOKUPS.inc(1, STORE['delete'])
+            return lst.delete(_id)
         for index in range(len(lst)):
             if lst[index].id == _id:
                 del lst[index]
+                Manager.__record_scan('delete', index + 1)
                 return True
+        Manager.__record_scan('delete', len(lst))
         return False
 
     @staticmethod
-    def find_by_id(lst: List[Any], _id: UUID) -> Optional[Any]:
-        for element in lst:
+    def find_by_id(lst: Union[List[Any], EntityStore], _id: UUID) -> Optional[Any]:
+        if isinstance(lst, EntityStore):
+            if metrics.enabled:
+                LOOKUPS.inc(1, STORE['find'])
+            return lst.find(_id)
+        for index, element in enumerate(lst):
             if element.id == _id:
+                Manager.__record_scan('find', index + 1)
                 return element
+        Manager.__record_scan('find', len(lst))
         return None
 
     @staticmethod
-    def add_element(lst: List[Any], element: Any) -> bool:
+    def add_element(lst: Union[List[Any], EntityStore], element: Any) -> bool:
+        if isinstance(lst, EntityStore):
+            if metrics.enabled:
+                LOOKUPS.inc(1, STORE['add'])
+            return lst.add(element)
+        Manager.__record_scan('add', len(lst))
         if element not in lst:
             lst.append(element)
             return True
         return False
+
+    @staticmethod
+    def __record_scan(operation: str, length: int):
+        if metrics.enabled:
+            LOOKUPS.inc(1, LIST[operation])
+            LIST_SCANS.observe(length)
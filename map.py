@@ -1,112 +1,770 @@
-from copy import copy
-from dataclasses import dataclass
-from datetime import time, timedelta
+from array import array
+from datetime import datetime, time, timedelta
+from heapq import heappop, heappush
 from os import path
 from random import randint
-from typing import List
+from threading import Lock, RLock, Thread
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
 
+import metrics
+from landmarks import Landmarks
 from manager import singleton
+from map_format import MapFile, is_binary_map, read_text_map, write_binary_map
+from route_cache import CacheInfo, RouteCache
+from traffic_profile import TrafficProfile, search_time_dependent, seconds_of_day
 
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, the packed array backend is used then
+    np = None
 
-@dataclass
-class Location:
-    def __init__(self, x: int, y: int):
-        self.x = x
-        self.y = y
+# Time to pass one unit of traffic, see Map.trip_time
+SECONDS_PER_TRAFFIC_UNIT = 33
 
-    def __eq__(self, other):
-        return self.x == other.x and self.y == other.y
+ROUTE_LOOKUPS = metrics.registry.counter('route_lookups',
+                                         'Map.find_way calls by route cache result')
+SEARCH_TIME = metrics.registry.timer('route_search_seconds', 'Time of grid searches by kind')
+SEARCH_EXPANDED = metrics.registry.histogram('route_search_expanded_cells',
+                                             'Cells settled by a grid search, by kind')
+ROUTE_LENGTH = metrics.registry.histogram('route_length_cells', 'Cells of found routes')
+CACHE_HIT, CACHE_MISS = metrics.labels(result='hit'), metrics.labels(result='miss')
+WAY_SEARCH, MANY_SEARCH = metrics.labels(kind='way'), metrics.labels(kind='one_to_many')
+TIMED_SEARCH = metrics.labels(kind='time_dependent')
 
-    def __hash__(self):
-        return int(str(hash(self.x)) + str(hash(self.y)))
+
+# A plain (x, y) tuple underneath: no per-object dict, and hashing and
+# comparison are done by the tuple in C
+class Location(NamedTuple):
+    x: int
+    y: int
 
     def __str__(self):
         return f"({self.x}, {self.y})"
 
 
+# Cells of a route and the version of the map snapshot it was found on
+class Route(list):
+    __slots__ = ('version',)
+
+    def __init__(self, cells: Iterable[Location] = (), version: int = 0):
+        super().__init__(cells)
+        self.version = version
+
+
+# Traffic of the whole map at one moment, never changed once published.
+# cells is a read-only int8 view indexed by x * width + y, rows are its row
+# views (a read-only numpy grid with use_numpy). stamp is the traffic_stamp
+# of the snapshot, version grows with every published snapshot. decreased
+# is the traffic taken off cells by deltas until the snapshot.
+class MapSnapshot(NamedTuple):
+    version: int
+    stamp: tuple
+    height: int
+    width: int
+    cells: memoryview
+    rows: Sequence
+    decreased: int = 0
+
+
+# Lower bound of the traffic from a cell to target: every cell on the way
+# costs at least min_traffic. Cells with no traffic cost nothing, so with
+# the default min_traffic of 0 the bound is 0 everywhere.
+def manhattan_estimate(width: int, min_traffic: int, target: int) -> Callable[[int], int]:
+    end_x, end_y = divmod(target, width)
+
+    def manhattan(cell: int) -> int:
+        x, y = divmod(cell, width)
+        return min_traffic * (abs(x - end_x) + abs(y - end_y))
+
+    return manhattan
+
+
+# A* from source to target over packed cells (see Map.load), ordered by
+# (traffic, cells). Returns the cells of the route, [] if target is
+# unreachable, and the number of cells expanded. With a zero estimate, like
+# the Manhattan one of a map with min_traffic 0, this is Dijkstra that
+# stops at target: only ALT bounds (see build_landmarks) prune the search.
+def search_cells(cells: Sequence[int], height: int, width: int, source: int, target: int,
+                 estimate: Callable[[int], int]) -> Tuple[List[int], int]:
+    inf = int(10 ** 10)
+
+    # Flat arrays indexed by x * width + y
+    distance = [inf] * (height * width)
+    length = [0] * (height * width)
+    parent = [-1] * (height * width)
+    settled = bytearray(height * width)
+
+    distance[source] = 0
+    heap = [(estimate(source), 0, source)]
+    expanded = 0
+
+    while heap:
+        _, hops, point = heappop(heap)
+        if settled[point]:
+            continue
+        settled[point] = 1
+        expanded += 1
+        if point == target:
+            break
+
+        x, y = divmod(point, width)
+        dist = distance[point]
+        hops += 1
+        for xx, yy in ((x - 1, y), (x, y - 1), (x + 1, y), (x, y + 1)):
+            if not (0 <= xx < height and 0 <= yy < width):
+                continue
+            cell = xx * width + yy
+            traffic = cells[cell]
+            if traffic == -1 or settled[cell]:
+                continue
+            new_dist = dist + traffic
+            if new_dist < distance[cell] or \
+                    (new_dist == distance[cell] and hops < length[cell]):
+                distance[cell] = new_dist
+                length[cell] = hops
+                parent[cell] = point
+                heappush(heap, (new_dist + estimate(cell), hops, cell))
+
+    # Target is unreachable
+    if not settled[target]:
+        return [], expanded
+
+    route = []
+    point = target
+    while point != -1:
+        route.append(point)
+        point = parent[point]
+    route.reverse()
+    return route, expanded
+
+
 @singleton
 class Map:
-    def __init__(self):  # map: 0 - can pass, -1 - can't pass
-        self.city_map = []
+    # map: 0 - can pass, -1 - can't pass
+    def __init__(self, file_name: str = 'map.txt', use_numpy: bool = False):
+        if use_numpy and np is None:
+            raise ImportError('numpy is required for use_numpy=True')
+        self.use_numpy = use_numpy
+
+        self.min_traffic = 0
+        self.max_traffic = 10
+
+        # Cached routes are valid only for the traffic version they were built on
+        self.traffic_version = 0
+        self.route_cache = RouteCache()
+        # Readers route on the snapshot they took without locks. Writers
+        # build the next cells aside one at a time, publishing it and
+        # dropping cached routes (or caching one) is done under __publish_lock.
+        self.__snapshot: Optional[MapSnapshot] = None
+        self.__version = 0
+        self.__write_lock = RLock()
+        self.__publish_lock = RLock()
+        # Searches run on the grid: route searches and one-to-many ones
+        self.search_count = 0
+        # Traffic by time of day for trips with a known departure
+        self.traffic_profile: Optional[TrafficProfile] = None
+
+        # ALT tables with the traffic stamp they were built on and the traffic
+        # taken off cells by deltas by then, see build_landmarks
+        self.landmark_count = 0
+        self.rebuild_threshold = 0.01
+        self.__landmarks: Optional[Tuple[tuple, Landmarks, int]] = None
+        self.__decreased = 0
+        self.__landmarks_lock = Lock()
+        self.__landmarks_thread: Optional[Thread] = None
+        self.__landmarks_pending = False
+        self.__traffic_edits = 0
+        self.__changed_cells = 0
 
-        if not path.exists('map.txt'):
+        self.load(file_name)
+
+    # Cells are packed into one flat int8 buffer indexed by x * width + y,
+    # city_map holds row views of the same memory. Binary maps (see
+    # map_format) are memory-mapped instead of parsed, and the traffic
+    # they hold is kept until the first change copies it.
+    def load(self, file_name: str):
+        if not path.exists(file_name):
             raise OSError("Fatal error: map-file doesn't exist")
-        with open('map.txt', 'r') as file:
-            lst = file.readlines()
 
-        self.city_map: List[List[int]] = \
-            [[int(cell) for cell in line.split()] for line in lst]
-        self.update_traffic()
+        with self.__write_lock:
+            self.__load(file_name)
+
+    def __load(self, file_name: str):
+        if is_binary_map(file_name):
+            map_file = MapFile(file_name)
+            self.height, self.width = map_file.height, map_file.width
+            has_traffic = map_file.has_traffic
+            if self.use_numpy:
+                cells = np.frombuffer(map_file.buffer, dtype=np.int8,
+                                      count=self.height * self.width,
+                                      offset=map_file.offset
+                                      ).reshape(self.height, self.width)
+            else:
+                cells = map_file.cells
+                self.obstacles = map_file.obstacles()
+        else:
+            rows = read_text_map(file_name)
+            self.height, self.width = len(rows), len(rows[0])
+            has_traffic = False
+            if self.use_numpy:
+                cells = np.array(rows, dtype=np.int8)
+            else:
+                cells = array('b', [cell for row in rows for cell in row])
+                self.obstacles = bytearray(cell == -1 for cell in cells)
+
+        if self.use_numpy:
+            self.obstacles = cells == -1
+
+        self.__landmarks = None
 
         # Limits of map
         self.min_x = 0
-        self.max_x = len(self.city_map) - 1
+        self.max_x = self.height - 1
         self.min_y = 0
-        self.max_y = len(self.city_map[0]) - 1
+        self.max_y = self.width - 1
 
-        self.min_traffic = 0
-        self.max_traffic = 10
+        if has_traffic:
+            self.__publish(cells, full=True)
+            self.__traffic_changed()
+        else:
+            self.__publish(cells, full=True)
+            self.update_traffic()
+
+    # Snapshot of the current traffic, routing on it needs no locks
+    def snapshot(self) -> MapSnapshot:
+        return self.__snapshot
+
+    @property
+    def city_map(self) -> Sequence:
+        return self.__snapshot.rows
+
+    @property
+    def _cells(self) -> memoryview:
+        return self.__snapshot.cells
+
+    # Writable copy of the current cells to build the next snapshot on
+    def __copy_cells(self):
+        if self.use_numpy:
+            return self.city_map.copy()
+        cells = array('b')
+        cells.frombytes(self._cells.tobytes())
+        return cells
+
+    # Make cells the current traffic. Readers that took the old snapshot
+    # keep it, cells must not be written to afterwards.
+    def __publish(self, cells, full: bool):
+        height, width = self.height, self.width
+        if self.use_numpy:
+            cells.flags.writeable = False
+            rows, view = cells, memoryview(cells.reshape(-1))
+        else:
+            view = memoryview(cells).toreadonly()
+            rows = [view[i * width:(i + 1) * width] for i in range(height)]
+        with self.__publish_lock:
+            if full:
+                self.traffic_version += 1
+            else:
+                self.__traffic_edits += 1
+            self.__version += 1
+            self.__snapshot = MapSnapshot(self.__version,
+                                          (self.traffic_version, self.__traffic_edits),
+                                          height, width, view, rows, self.__decreased)
+
+    # Current cells with traffic as a binary map, see map_format
+    def save(self, file_name: str):
+        write_binary_map(file_name, self.height, self.width, self._cells, traffic=True)
 
     def __getitem__(self, item: int):
         return self.city_map[item]
 
-    def update_traffic(self):
-        for i in range(len(self.city_map)):
-            for j in range(len(self.city_map[i])):
-                if self.city_map[i][j] != -1:
-                    self.city_map[i][j] = randint(self.min_traffic, self.max_traffic)
+    def traffic(self, location: Location) -> int:
+        return self._cells[location.x * self.width + location.y]
+
+    # New random traffic, or the given height x width grid of values.
+    # Obstacles are kept in both cases.
+    # The next snapshot is built aside, routing goes on meanwhile.
+    def update_traffic(self, traffic: Optional[Sequence[Sequence[int]]] = None):
+        with self.__write_lock:
+            cells = self.__copy_cells()
+            if self.use_numpy:
+                self.__update_traffic_numpy(cells, traffic)
+            else:
+                self.__update_traffic_packed(cells, traffic)
+            self.__publish(cells, full=True)
+        self.__traffic_changed()
+
+    # Routes cached for older traffic versions are never looked up again
+    def __traffic_changed(self):
+        self.route_cache.clear()
+        if self.landmark_count:
+            self.__rebuild_landmarks_async()
+
+    def __update_traffic_numpy(self, grid, traffic: Optional[Sequence[Sequence[int]]]):
+        if traffic is None:
+            values = np.random.randint(self.min_traffic, self.max_traffic + 1,
+                                       size=grid.shape, dtype=np.int8)
+        else:
+            values = np.asarray(traffic)
+            if values.shape != grid.shape:
+                raise ValueError(f'Traffic should be a {self.height}x{self.width} grid')
+            free = values[~self.obstacles]
+            if free.size and (free.min() < self.min_traffic or free.max() > self.max_traffic):
+                raise ValueError(f'Traffic should be between '
+                                 f'{self.min_traffic} and {self.max_traffic}')
+        np.copyto(grid, values, casting='unsafe', where=~self.obstacles)
+
+    def __update_traffic_packed(self, cells: array, traffic: Optional[Sequence[Sequence[int]]]):
+        obstacles = self.obstacles
+        if traffic is None:
+            for i in range(len(cells)):
+                if not obstacles[i]:
+                    cells[i] = randint(self.min_traffic, self.max_traffic)
+            return
+
+        if len(traffic) != self.height or \
+                any(len(row) != self.width for row in traffic):
+            raise ValueError(f'Traffic should be a {self.height}x{self.width} grid')
+        values = [value for row in traffic for value in row]
+        for i, value in enumerate(values):
+            if not obstacles[i] and not self.min_traffic <= value <= self.max_traffic:
+                raise ValueError(f'Traffic should be between '
+                                 f'{self.min_traffic} and {self.max_traffic}')
+        for i, value in enumerate(values):
+            if not obstacles[i]:
+                cells[i] = value
 
-    # Dijkstra implementation
-    def find_way(self, start: Location, end: Location) -> List[Location]:
+    # Traffic of the profile layer in effect at the moment
+    def use_traffic_at(self, moment: datetime):
+        if self.traffic_profile is None:
+            raise ValueError('Map has no traffic profile, see set_traffic_profile')
+        layer = self.traffic_profile.layer_at(moment)
+        self.update_traffic([layer[x * self.width:(x + 1) * self.width]
+                             for x in range(self.height)])
+
+    # Profile of the same size as the map, None turns time-dependent
+    # estimates off. The obstacles of the profile are used by its searches.
+    def set_traffic_profile(self, profile: Optional[TrafficProfile]):
+        if profile is not None and (profile.height, profile.width) != (self.height, self.width):
+            raise ValueError(f'Traffic profile should be {self.height}x{self.width}')
+        self.traffic_profile = profile
+
+    # Change traffic in a few cells. Only cached routes that can be affected
+    # are dropped: the ones through a cell that got slower, and the ones a
+    # cell that got faster could undercut. Telling the latter needs the ALT
+    # tables of build_landmarks, without them a faster cell drops nearly
+    # the whole cache. Returns the number of dropped routes.
+    def apply_traffic_delta(self, cells: Sequence[Location], values: Sequence[int]) -> int:
+        if len(cells) != len(values):
+            raise ValueError('cells and values should have the same length')
+        for cell, value in zip(cells, values):
+            if not (0 <= cell.x < self.height and 0 <= cell.y < self.width):
+                raise ValueError(f'Cell {cell} is out of the map')
+            if self._cells[cell.x * self.width + cell.y] == -1:
+                raise ValueError(f'Cell {cell} is an obstacle')
+            if not self.min_traffic <= value <= self.max_traffic:
+                raise ValueError(f'Traffic should be between '
+                                 f'{self.min_traffic} and {self.max_traffic}')
+
+        with self.__write_lock:
+            current = self._cells
+            slower: List[int] = []
+            faster: Dict[int, int] = {}
+            changed: Dict[int, int] = {}
+            for cell, value in zip(cells, values):
+                index = cell.x * self.width + cell.y
+                previous = changed.get(index, current[index])
+                if value > previous:
+                    slower.append(index)
+                elif value < previous:
+                    faster[index] = value
+                changed[index] = value
+            if not (slower or faster):
+                return 0
+
+            copy = self.__copy_cells()
+            flat = copy.reshape(-1) if self.use_numpy else copy
+            for index, value in changed.items():
+                flat[index] = value
+            # Routes found on the old cells can't be cached in between, and
+            # readers of the new snapshot never see the dropped ones
+            decrease = sum(max(0, current[index] - value) for index, value in changed.items())
+            with self.__publish_lock:
+                self.__decreased += decrease
+                dropped = self.route_cache.invalidate_cells(slower)
+                if faster:
+                    bounds = self.__undercut_bounds()
+                    dropped += self.route_cache.invalidate_where(
+                        lambda key, cost: self.__may_undercut(key, cost, faster, bounds))
+                self.__publish(copy, full=False)
+
+            # ALT tables stay exact lower bounds while traffic only rises,
+            # they just get looser. A cell that got faster turns them off
+            # for the new snapshots until they are rebuilt.
+            self.__changed_cells += len(slower) + len(faster)
+            if self.landmark_count and (decrease or self.__changed_cells >=
+                                        self.rebuild_threshold * self.height * self.width):
+                self.__rebuild_landmarks_async()
+        return dropped
+
+    # ALT tables of the current traffic version and the traffic deltas took
+    # off cells since they were built, or None if there are none
+    def __undercut_bounds(self) -> Optional[Tuple[Landmarks, int]]:
+        landmarks = self.__landmarks
+        if landmarks is None or landmarks[0][0] != self.traffic_version:
+            return None
+        return landmarks[1], self.__decreased - landmarks[2]
+
+    # Whether a way through one of the faster cells can be as cheap as cost.
+    # Without bounds only the Manhattan one is left, and with min_traffic 0
+    # it drops nearly every cached route: build_landmarks to keep them.
+    # An ALT bound of the tables is less than the cost of a way on the
+    # cells they were built on, and a way gets cheaper by at most the
+    # traffic taken off cells since then.
+    def __may_undercut(self, key: tuple, cost: int, faster: Dict[int, int],
+                       bounds: Optional[Tuple[Landmarks, int]]) -> bool:
+        start_x, start_y, end_x, end_y = key[:4]
+        source, target = start_x * self.width + start_y, end_x * self.width + end_y
+        for index, value in faster.items():
+            x, y = divmod(index, self.width)
+            to_cell = abs(x - start_x) + abs(y - start_y)
+            if to_cell == 0:
+                continue
+            from_cell = abs(end_x - x) + abs(end_y - y)
+            if value + self.min_traffic * (to_cell - 1 + from_cell) > cost:
+                continue
+            if bounds is not None:
+                landmarks, decreased = bounds
+                if landmarks.lower_bound(source, index) + \
+                        landmarks.lower_bound(index, target) - decreased > cost:
+                    continue
+            return True
+        return False
+
+    # Tables built on the snapshot, or on an older one of the same traffic
+    # version with only rises of traffic after it: their bounds stay
+    # admissible and consistent on it
+    @staticmethod
+    def __landmarks_valid(landmarks: Optional[Tuple[tuple, Landmarks, int]],
+                          snapshot: MapSnapshot) -> bool:
+        if landmarks is None:
+            return False
+        (traffic_version, edits), _, decreased = landmarks
+        return traffic_version == snapshot.stamp[0] and edits <= snapshot.stamp[1] and \
+            decreased == snapshot.decreased
+
+    def cache_info(self) -> CacheInfo:
+        return self.route_cache.info()
+
+    # Pick count landmarks and precompute exact traffic costs from and to
+    # them for the ALT heuristic. Deltas that only raise traffic keep the
+    # tables in use, they are rebuilt in the background once rebuild_threshold
+    # of cells got new traffic. After update_traffic or a delta that lowers
+    # a cell they are rebuilt at once, until then A* falls back to the
+    # Manhattan bound.
+    def build_landmarks(self, count: int = 8, background: bool = False,
+                        rebuild_threshold: float = 0.01):
+        if count <= 0:
+            raise ValueError('count should be positive')
+        self.landmark_count = count
+        self.rebuild_threshold = rebuild_threshold
+        if background:
+            self.__rebuild_landmarks_async()
+        else:
+            self.__rebuild_landmarks()
+
+    def landmarks_ready(self) -> bool:
+        return self.__landmarks_valid(self.__landmarks, self.__snapshot)
+
+    # Changes with every change of traffic, deltas included
+    def traffic_stamp(self) -> tuple:
+        return self.__snapshot.stamp
+
+    def __rebuild_landmarks(self):
+        with self.__publish_lock:
+            snapshot, decreased = self.__snapshot, self.__decreased
+        self.__changed_cells = 0
+        self.__landmarks = (snapshot.stamp, Landmarks(snapshot.cells.tolist(), snapshot.height,
+                                                      snapshot.width, self.landmark_count),
+                            decreased)
+
+    def __rebuild_landmarks_async(self):
+        with self.__landmarks_lock:
+            if self.__landmarks_thread is not None:
+                self.__landmarks_pending = True
+                return
+            self.__landmarks_thread = Thread(target=self.__landmarks_worker, daemon=True)
+            self.__landmarks_thread.start()
+
+    def __landmarks_worker(self):
+        while True:
+            self.__rebuild_landmarks()
+            with self.__landmarks_lock:
+                if not self.__landmarks_pending:
+                    self.__landmarks_thread = None
+                    return
+                self.__landmarks_pending = False
+
+    # Every routing method works on the given snapshot, by default the
+    # current one. The cache holds routes of the current snapshot only.
+    def find_way(self, start: Location, end: Location,
+                 snapshot: Optional[MapSnapshot] = None) -> Route:
+        if snapshot is None:
+            snapshot = self.__snapshot
+        route = self.cached_way(start, end, snapshot)
+        if metrics.enabled:
+            ROUTE_LOOKUPS.inc(1, CACHE_HIT if route is not None else CACHE_MISS)
+        if route is None:
+            route, _ = self.search_way(start, end, snapshot=snapshot)
+            self.cache_way(start, end, route, snapshot)
+        return route
+
+    def cached_way(self, start: Location, end: Location,
+                   snapshot: Optional[MapSnapshot] = None) -> Optional[Route]:
+        if snapshot is None:
+            snapshot = self.__snapshot
+        route = self.route_cache.get((start.x, start.y, end.x, end.y, snapshot.stamp[0]))
+        if route is None or snapshot is not self.__snapshot:
+            return None
+        return Route(route, snapshot.version)
+
+    # Remember a route found on the snapshot elsewhere, see parallel_routing.
+    # Nothing is cached once a newer snapshot is published.
+    def cache_way(self, start: Location, end: Location, route: List[Location],
+                  snapshot: Optional[MapSnapshot] = None):
+        with self.__publish_lock:
+            current = self.__snapshot
+            if snapshot is not None and snapshot is not current:
+                return
+            key = (start.x, start.y, end.x, end.y, current.stamp[0])
+            cells = [cell.x * current.width + cell.y for cell in route[1:]]
+            self.route_cache.put(key, route, sum(current.cells[cell] for cell in cells), cells)
+
+    # A* on a binary heap, bypassing the cache. Returns the route and the
+    # number of cells the search expanded. heuristic is one of
+    #   'dijkstra'  - no heuristic,
+    #   'manhattan' - Manhattan distance times the cheapest traffic, the
+    #                 same as 'dijkstra' while min_traffic is 0,
+    #   'landmarks' - ALT bounds from build_landmarks, if they are up to
+    #                 date, otherwise the same as 'manhattan'.
+    # All of them are lower bounds of the rest of the way, so routes stay
+    # optimal. Among routes of equal traffic the one with fewer cells is chosen.
+    def search_way(self, start: Location, end: Location, heuristic: str = 'landmarks',
+                   snapshot: Optional[MapSnapshot] = None) -> Tuple[Route, int]:
+        if snapshot is None:
+            snapshot = self.__snapshot
+        if start == end:
+            return Route((), snapshot.version), 0
+        self.search_count += 1
+        started = perf_counter() if metrics.enabled else None
+        width = snapshot.width
+        target = end.x * width + end.y
+        route, expanded = search_cells(snapshot.cells, snapshot.height, width,
+                                       start.x * width + start.y, target,
+                                       self.__heuristic(target, heuristic, snapshot))
+        if started is not None:
+            SEARCH_TIME.observe(perf_counter() - started, WAY_SEARCH)
+            SEARCH_EXPANDED.observe(expanded, WAY_SEARCH)
+            ROUTE_LENGTH.observe(len(route))
+        return Route((Location(*divmod(point, width)) for point in route),
+                     snapshot.version), expanded
+
+    def __heuristic(self, target: int, heuristic: str,
+                    snapshot: MapSnapshot) -> Callable[[int], int]:
+        if heuristic not in ('dijkstra', 'manhattan', 'landmarks'):
+            raise ValueError(f'Unknown heuristic {heuristic}')
+        if heuristic == 'dijkstra':
+            return lambda cell: 0
+
+        manhattan = manhattan_estimate(snapshot.width, self.min_traffic, target)
+        landmarks = self.__landmarks
+        if heuristic == 'manhattan' or not self.__landmarks_valid(landmarks, snapshot):
+            return manhattan
+
+        alt = landmarks[1].heuristic_to(target)
+        return lambda cell: max(manhattan(cell), alt(cell))
+
+    # Distances from start to many targets (or to every cell closer than
+    # max_dist) with a single search. Values match Map.distance for the
+    # same pair, unreachable and too distant cells are left out.
+    def distances_from(self, start: Location,
+                       targets: Optional[Iterable[Location]] = None,
+                       max_dist: Optional[float] = None,
+                       snapshot: Optional[MapSnapshot] = None) -> Dict[Location, int]:
+        return self.__search(start, targets, max_dist, snapshot, reverse=False)
+
+    # Same as distances_from, but measures the way from every source to end
+    def distances_to(self, end: Location,
+                     sources: Optional[Iterable[Location]] = None,
+                     max_dist: Optional[float] = None,
+                     snapshot: Optional[MapSnapshot] = None) -> Dict[Location, int]:
+        return self.__search(end, sources, max_dist, snapshot, reverse=True)
+
+    # (cells, traffic) of the way from start to every target, found by one
+    # search. The values match len(find_way(...)) and the traffic summed over
+    # the cells of that way, start cell included, as trip_time counts it.
+    def ways_from(self, start: Location, targets: Iterable[Location],
+                  max_dist: Optional[float] = None,
+                  snapshot: Optional[MapSnapshot] = None) -> Dict[Location, Tuple[int, int]]:
+        return self.__search(start, targets, max_dist, snapshot, reverse=False,
+                             with_traffic=True)
+
+    # Same as ways_from, but for the way from every source to end
+    def ways_to(self, end: Location, sources: Iterable[Location],
+                max_dist: Optional[float] = None,
+                snapshot: Optional[MapSnapshot] = None) -> Dict[Location, Tuple[int, int]]:
+        return self.__search(end, sources, max_dist, snapshot, reverse=True, with_traffic=True)
+
+    # (cells, traffic) of the way from start to end, like ways_from
+    def way_cost(self, start: Location, end: Location,
+                 snapshot: Optional[MapSnapshot] = None) -> Tuple[int, int]:
+        if snapshot is None:
+            snapshot = self.__snapshot
+        way = self.find_way(start, end, snapshot)
+        cells, width = snapshot.cells, snapshot.width
+        return len(way), sum(cells[cell.x * width + cell.y] for cell in way)
+
+    # Dijkstra from origin ordered by (traffic, cells), like search_way.
+    # In reverse mode the edges are walked backwards, so the traffic of the
+    # cell being left is paid instead of the traffic of the cell entered.
+    def __search(self, origin: Location,
+                 targets: Optional[Iterable[Location]],
+                 max_dist: Optional[float],
+                 snapshot: Optional[MapSnapshot],
+                 reverse: bool,
+                 with_traffic: bool = False) -> Dict[Location, Any]:
+        if snapshot is None:
+            snapshot = self.__snapshot
+        height, width = snapshot.height, snapshot.width
+        cells = snapshot.cells
         inf = int(10 ** 10)
-        bad_location = Location(-1, -1)
-
-        distance = [[inf] * len(self.city_map[0]) for _ in
-                    range(len(self.city_map))]
-        distance[start.x][start.y] = 0
-        parent = {start: bad_location}
-        s = {(distance[start.x][start.y], start)}
-
-        # Utility func
-        def update_vertex(xx: int, yy: int):
-            if self.city_map[xx][yy] + dist < distance[xx][yy]:
-                distance[xx][yy] = self.city_map[xx][yy] + dist
-                s.add((distance[xx][yy], Location(xx, yy)))
-                parent[Location(xx, yy)] = point
-
-        while len(s) > 0:
-            dist, point = s.pop()
-            x, y = point.x, point.y
-
-            if x >= 1 and self.city_map[x - 1][y] != -1:
-                update_vertex(x - 1, y)
-            if y >= 1 and self.city_map[x][y - 1] != -1:
-                update_vertex(x, y - 1)
-            if x < len(self.city_map) - 1 and self.city_map[x + 1][y] != -1:
-                update_vertex(x + 1, y)
-            if y < len(self.city_map[0]) - 1 and self.city_map[x][y + 1] != -1:
-                update_vertex(x, y + 1)
-
-        if distance[end.x][end.y] == 0:
-            return []
-
-        current_point = copy(end)
-        result = [current_point]
-        while parent[current_point] != bad_location:
-            current_point = parent[current_point]
-            result.append(current_point)
-        result.reverse()
+
+        # A route shorter than max_dist cells can't cost more than this
+        max_cost = inf if max_dist is None else self.max_traffic * max_dist
+
+        def in_range(location: Location) -> bool:
+            return max_dist is None or location == origin or \
+                abs(location.x - origin.x) + abs(location.y - origin.y) + 1 < max_dist
+
+        wanted: Dict[int, List[Location]] = {}
+        if targets is not None:
+            for location in targets:
+                if in_range(location):
+                    wanted.setdefault(location.x * width + location.y, []).append(location)
+            if not wanted:
+                return {}
+
+        self.search_count += 1
+        started = perf_counter() if metrics.enabled else None
+        distance = [inf] * (height * width)
+        length = [0] * (height * width)
+        settled = bytearray(height * width)
+
+        source = origin.x * width + origin.y
+        distance[source] = 0
+        heap = [(0, 0, source)]
+        result: Dict[Location, Any] = {}
+
+        while heap:
+            dist, hops, point = heappop(heap)
+            if settled[point]:
+                continue
+            if dist > max_cost:
+                break
+            settled[point] = 1
+
+            x, y = divmod(point, width)
+            count = 0 if point == source else hops + 1
+            if max_dist is None or count < max_dist:
+                value: Any = count
+                if with_traffic:
+                    # dist leaves out the first cell of the way
+                    value = (count, dist + cells[point if reverse else source]) \
+                        if count else (0, 0)
+                if targets is None:
+                    result[Location(x, y)] = value
+                elif point in wanted:
+                    for location in wanted.pop(point):
+                        result[location] = value
+                    if not wanted:
+                        break
+
+            traffic = cells[point]
+            if reverse and traffic == -1:
+                # A route may start on an obstacle, but never pass through it
+                continue
+            hops += 1
+            for xx, yy in ((x - 1, y), (x, y - 1), (x + 1, y), (x, y + 1)):
+                if not (0 <= xx < height and 0 <= yy < width):
+                    continue
+                cell = xx * width + yy
+                if settled[cell]:
+                    continue
+                if reverse:
+                    new_dist = dist + traffic
+                elif cells[cell] == -1:
+                    continue
+                else:
+                    new_dist = dist + cells[cell]
+                if new_dist < distance[cell] or \
+                        (new_dist == distance[cell] and hops < length[cell]):
+                    distance[cell] = new_dist
+                    length[cell] = hops
+                    heappush(heap, (new_dist, hops, cell))
+
+        if started is not None:
+            SEARCH_TIME.observe(perf_counter() - started, MANY_SEARCH)
+            SEARCH_EXPANDED.observe(settled.count(1), MANY_SEARCH)
         return result
 
-    def distance(self, start: Location, end: Location) -> int:
-        return len(self.find_way(start, end))
+    def distance(self, start: Location, end: Location,
+                 snapshot: Optional[MapSnapshot] = None) -> int:
+        return len(self.find_way(start, end, snapshot))
+
+    # Fastest route leaving start at departure through the traffic of the
+    # profile, and the moment it reaches end. The traffic of a cell is the
+    # one of the time the route enters it. The route gets the version of the
+    # snapshot current when it was searched for.
+    def find_way_at(self, start: Location, end: Location, departure: datetime,
+                    seconds_per_traffic_unit: int = SECONDS_PER_TRAFFIC_UNIT,
+                    snapshot: Optional[MapSnapshot] = None) -> Tuple[Route, datetime]:
+        profile = self.traffic_profile
+        if profile is None:
+            raise ValueError('Map has no traffic profile, see set_traffic_profile')
+        if snapshot is None:
+            snapshot = self.__snapshot
+        if start == end:
+            return Route((), snapshot.version), departure
+        self.search_count += 1
+        started = perf_counter() if metrics.enabled else None
+        width = snapshot.width
+        leave = seconds_of_day(departure)
+        route, arrival = search_time_dependent(profile, start.x * width + start.y,
+                                               end.x * width + end.y, leave,
+                                               seconds_per_traffic_unit)
+        if started is not None:
+            SEARCH_TIME.observe(perf_counter() - started, TIMED_SEARCH)
+        return (Route((Location(*divmod(point, width)) for point in route), snapshot.version),
+                departure + timedelta(seconds=arrival - leave))
+
+    # Seconds from start to end. With a departure and a traffic profile the
+    # route goes through the traffic of the time of day, otherwise the
+    # current traffic is used for the whole route.
+    def travel_seconds(self, start: Location, end: Location,
+                       departure: Optional[datetime] = None,
+                       seconds_per_traffic_unit: int = SECONDS_PER_TRAFFIC_UNIT,
+                       snapshot: Optional[MapSnapshot] = None) -> int:
+        if departure is not None and self.traffic_profile is not None:
+            _, arrival = self.find_way_at(start, end, departure, seconds_per_traffic_unit,
+                                          snapshot)
+            return round((arrival - departure).total_seconds())
+        _, traffic = self.way_cost(start, end, snapshot)
+        return seconds_per_traffic_unit * traffic
 
     def trip_time(self, start: Location,
                   end: Location,
-                  seconds_per_traffic_unit: int = 33) -> time:
-        trip_time = time(second=0)
-        way = self.find_way(start, end)
-        for cell in way:
-            trip_time += timedelta(seconds=seconds_per_traffic_unit) * \
-                         self.city_map[cell.x][cell.y]
-        return trip_time
+                  seconds_per_traffic_unit: int = SECONDS_PER_TRAFFIC_UNIT,
+                  departure: Optional[datetime] = None,
+                  snapshot: Optional[MapSnapshot] = None) -> time:
+        seconds = self.travel_seconds(start, end, departure, seconds_per_traffic_unit, snapshot)
+        return (datetime.min + timedelta(seconds=seconds)).time()
@@ -0,0 +1,117 @@
+import argparse
+import mmap
+import struct
+from array import array
+from random import Random
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+# Binary map: header, then height * width int8 cells row by row
+# (x * width + y), -1 - can't pass, otherwise traffic
+MAGIC = b'TAXIMAP\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sHHII')  # magic, version, flags, height, width
+
+# Cells hold traffic values, not just the 0 / -1 layout
+FLAG_TRAFFIC = 1
+
+# bytes.translate table turning packed cells into an obstacle mask
+OBSTACLE_TABLE = bytes(1 if byte == 0xFF else 0 for byte in range(256))
+
+
+def is_binary_map(file_name: str) -> bool:
+    with open(file_name, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def read_text_map(file_name: str) -> List[List[int]]:
+    with open(file_name, 'r') as file:
+        rows = [[int(cell) for cell in line.split()] for line in file if line.strip()]
+    if not rows or any(len(row) != len(rows[0]) for row in rows):
+        raise ValueError('Map should be a non-empty rectangle')
+    return rows
+
+
+def write_binary_map(file_name: str, height: int, width: int,
+                     cells: Sequence[int], traffic: bool = False):
+    if len(cells) != height * width:
+        raise ValueError(f'Expected {height * width} cells, got {len(cells)}')
+    with open(file_name, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, FLAG_TRAFFIC if traffic else 0,
+                               height, width))
+        file.write(cells.tobytes() if hasattr(cells, 'tobytes') else array('b', cells).tobytes())
+
+
+# Obstacles of a text map with random traffic in every free cell, like
+# Map.update_traffic. Written once here, the map loads without touching
+# its cells, see MapFile. Without traffic Map.load generates it in every
+# process, which takes as long as parsing the text map.
+def convert_text_map(text_file: str, binary_file: str, traffic: bool = True,
+                     min_traffic: int = 0, max_traffic: int = 10, seed: Optional[int] = None):
+    rows = read_text_map(text_file)
+    cells = array('b', [cell for row in rows for cell in row])
+    if traffic:
+        values = Random(seed).choices(range(min_traffic, max_traffic + 1), k=len(cells))
+        cells = array('b', [-1 if cell == -1 else value for cell, value in zip(cells, values)])
+    write_binary_map(binary_file, len(rows), len(rows[0]), cells, traffic)
+
+
+# Memory-mapped binary map. Pages are read from disk only when touched and
+# are shared between processes mapping the same file until one of them
+# writes to its copy (the file itself is never modified).
+class MapFile:
+    def __init__(self, file_name: str):
+        with open(file_name, 'rb') as file:
+            self.__mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        if len(self.__mmap) < HEADER.size:
+            raise ValueError(f'{file_name} is too short for a map header')
+        magic, version, flags, height, width = HEADER.unpack_from(self.__mmap)
+        if magic != MAGIC:
+            raise ValueError(f'{file_name} is not a binary map')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported map format version {version}')
+        if len(self.__mmap) != HEADER.size + height * width:
+            raise ValueError(f'{file_name} should hold {height * width} cells')
+
+        self.height = height
+        self.width = width
+        self.has_traffic = bool(flags & FLAG_TRAFFIC)
+        self.offset = HEADER.size
+
+    @property
+    def buffer(self) -> mmap.mmap:
+        return self.__mmap
+
+    # Writable int8 view of all cells
+    @property
+    def cells(self) -> memoryview:
+        return memoryview(self.__mmap)[self.offset:].cast('b')
+
+    def obstacles(self) -> bytearray:
+        return bytearray(self.__mmap[self.offset:].translate(OBSTACLE_TABLE))
+
+    # Rows x0..x0+rows-1, columns y0..y0+cols-1, touching only their pages
+    def read_tile(self, x0: int, y0: int, rows: int, cols: int) -> List[List[int]]:
+        if not (0 <= x0 and 0 <= y0 and x0 + rows <= self.height and y0 + cols <= self.width):
+            raise ValueError('Tile should lie inside the map')
+        cells = self.cells
+        return [cells[(x0 + x) * self.width + y0:(x0 + x) * self.width + y0 + cols].tolist()
+                for x in range(rows)]
+
+    def tiles(self, tile_size: int) -> Iterator[Tuple[int, int, List[List[int]]]]:
+        for x0 in range(0, self.height, tile_size):
+            for y0 in range(0, self.width, tile_size):
+                yield x0, y0, self.read_tile(x0, y0, min(tile_size, self.height - x0),
+                                             min(tile_size, self.width - y0))
+
+
+# Deploy the output: every process maps the same pages of it
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a text map to a binary one')
+    parser.add_argument('text_file')
+    parser.add_argument('binary_file')
+    parser.add_argument('--no-traffic', action='store_true',
+                        help='keep obstacles only, traffic is generated on every load')
+    parser.add_argument('--seed', type=int, help='seed of the traffic')
+    args = parser.parse_args()
+    convert_text_map(args.text_file, args.binary_file, not args.no_traffic, seed=args.seed)
@@ -0,0 +1,86 @@
+from typing import List, Sequence, Tuple
+
+# (cost, row, column) of a pair that may be matched
+Edge = Tuple[int, int, int]
+
+
+# Minimum cost assignment of rows to columns (Hungarian algorithm with
+# potentials, O(rows^2 * columns)). Pairs costing forbidden or more are
+# not returned.
+def hungarian(cost: Sequence[Sequence[int]], forbidden: int) -> List[Tuple[int, int]]:
+    if not cost or not cost[0]:
+        return []
+    transposed = len(cost) > len(cost[0])
+    if transposed:
+        cost = [list(column) for column in zip(*cost)]
+    n, m = len(cost), len(cost[0])
+
+    inf = float('inf')
+    u = [0] * (n + 1)
+    v = [0] * (m + 1)
+    match = [0] * (m + 1)  # column -> row, 1-based, 0 - free
+    way = [0] * (m + 1)
+    for i in range(1, n + 1):
+        match[0] = i
+        j0 = 0
+        min_v = [inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = match[j0]
+            row, u_i0 = cost[i0 - 1], u[i0]
+            delta, j1 = inf, 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    current = row[j - 1] - u_i0 - v[j]
+                    if current < min_v[j]:
+                        min_v[j] = current
+                        way[j] = j0
+                    if min_v[j] < delta:
+                        delta, j1 = min_v[j], j
+            for j in range(m + 1):
+                if used[j]:
+                    u[match[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_v[j] -= delta
+            j0 = j1
+            if match[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+
+    pairs = [(match[j] - 1, j - 1) for j in range(1, m + 1)
+             if match[j] and cost[match[j] - 1][j - 1] < forbidden]
+    return [(j, i) for i, j in pairs] if transposed else pairs
+
+
+# Cheapest pairs first, every row and column used once
+def greedy(edges: Sequence[Edge]) -> List[Tuple[int, int]]:
+    used_rows, used_columns = set(), set()
+    pairs = []
+    for _, row, column in sorted(edges):
+        if row not in used_rows and column not in used_columns:
+            used_rows.add(row)
+            used_columns.add(column)
+            pairs.append((row, column))
+    return pairs
+
+
+# Exact assignment for batches up to exact_limit rows and columns, greedy
+# above that: the Hungarian algorithm is cubic and needs a dense matrix
+def assign(edges: Sequence[Edge], rows: int, columns: int,
+           exact_limit: int = 300) -> List[Tuple[int, int]]:
+    if not edges:
+        return []
+    if max(rows, columns) > exact_limit:
+        return greedy(edges)
+
+    # Any real assignment is cheaper than a single forbidden pair
+    forbidden = sum(cost for cost, _, _ in edges) + 1
+    cost = [[forbidden] * columns for _ in range(rows)]
+    for value, row, column in edges:
+        cost[row][column] = min(cost[row][column], value)
+    return hungarian(cost, forbidden)
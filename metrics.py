@@ -0,0 +1,218 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+# Instrumented code checks this flag before touching any metric, so a
+# disabled registry costs one global lookup per call site:
+#     if metrics.enabled:
+#         SEARCHES.inc()
+enabled = False
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Upper bounds for durations in seconds and for sizes like cells of a way
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000, 100000)
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def labels(**values) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in values.items()))
+
+
+def counter_name(name: str) -> str:
+    return name if name.endswith('_total') else name + '_total'
+
+
+# Monotonic sum per label set. Its name ends with _total, like the name
+# of its samples, so the TYPE line declares the family they belong to.
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str):
+        self.name = counter_name(name)
+        self.description = description
+        self.values: Dict[Labels, float] = {}
+        self.__lock = Lock()
+
+    def inc(self, amount: float = 1, label_set: Labels = ()):
+        with self.__lock:
+            self.values[label_set] = self.values.get(label_set, 0) + amount
+
+    def reset(self):
+        with self.__lock:
+            self.values = {}
+
+    def snapshot(self) -> Dict[Labels, float]:
+        with self.__lock:
+            return dict(self.values)
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for label_set, value in self.snapshot().items():
+            yield self.name, label_set, value
+
+
+# Counts of observations per bucket, plus their sum and number
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = SIZE_BUCKETS):
+        if list(buckets) != sorted(set(buckets)):
+            raise ValueError('buckets should be increasing')
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        # label set -> [count per bucket and one for +Inf, sum]
+        self.values: Dict[Labels, List[float]] = {}
+        self.__lock = Lock()
+
+    def observe(self, value: float, label_set: Labels = ()):
+        with self.__lock:
+            state = self.values.get(label_set)
+            if state is None:
+                state = self.values[label_set] = [0] * (len(self.buckets) + 2)
+            state[bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    def reset(self):
+        with self.__lock:
+            self.values = {}
+
+    def snapshot(self) -> Dict[Labels, dict]:
+        with self.__lock:
+            values = {label_set: list(state) for label_set, state in self.values.items()}
+        return {label_set: {'buckets': dict(zip(self.buckets + (float('inf'),), state[:-1])),
+                            'count': sum(state[:-1]), 'sum': state[-1]}
+                for label_set, state in values.items()}
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for label_set, state in self.snapshot().items():
+            total = 0
+            for bound, count in state['buckets'].items():
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield self.name + '_bucket', label_set + (('le', le),), total
+            yield self.name + '_sum', label_set, state['sum']
+            yield self.name + '_count', label_set, state['count']
+
+
+# Histogram of durations in seconds
+class Timer(Histogram):
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = TIME_BUCKETS):
+        super().__init__(name, description, buckets)
+
+    @contextmanager
+    def time(self, label_set: Labels = ()) -> Iterator[None]:
+        if not enabled:
+            yield
+            return
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, label_set)
+
+
+# Metrics by name. Modules register theirs once at import, the same name
+# always gives the same metric.
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Union[Counter, Histogram]] = {}
+        self.__lock = Lock()
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self.__register(Counter, counter_name(name), description)
+
+    def histogram(self, name: str, description: str,
+                  buckets: Sequence[float] = SIZE_BUCKETS) -> Histogram:
+        return self.__register(Histogram, name, description, buckets)
+
+    def timer(self, name: str, description: str,
+              buckets: Sequence[float] = TIME_BUCKETS) -> Timer:
+        return self.__register(Timer, name, description, buckets)
+
+    def __register(self, kind: type, name: str, *args):
+        with self.__lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = kind(name, *args)
+            elif type(metric) is not kind:
+                raise ValueError(f'Metric {name} is already registered as {metric.kind}')
+            return metric
+
+    def reset(self):
+        for metric in list(self.metrics.values()):
+            metric.reset()
+
+    # name -> [(labels as dict, value)], plain data for logs and tests
+    def snapshot(self) -> Dict[str, list]:
+        return {name: [(dict(label_set), value)
+                       for label_set, value in metric.snapshot().items()]
+                for name, metric in sorted(self.metrics.items())}
+
+    # Prometheus text exposition format
+    def prometheus_text(self) -> str:
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            description = metric.description.replace('\\', '\\\\').replace('\n', '\\n')
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for sample, label_set, value in metric.samples():
+                if label_set:
+                    text = ','.join(f'{key}="{_escape(label)}"' for key, label in label_set)
+                    sample = f'{sample}{{{text}}}'
+                lines.append(f'{sample} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+    # Replaces the file at once, so a collector never reads half of it
+    def write_prometheus(self, file_name: str):
+        temporary = f'{file_name}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as file:
+            file.write(self.prometheus_text())
+        os.replace(temporary, file_name)
+
+
+# Not a @singleton: manager imports this module to instrument its lookups
+registry = MetricsRegistry()
+
+
+def _escape(label: str) -> str:
+    return label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Profiles the body with cProfile, e.g. a single request:
+#     with profile('offer.prof'):
+#         OfferDirector().make_offers(requests)
+# The stats are dumped to output for pstats or snakeviz, without output
+# the top limit functions by sort are printed.
+@contextmanager
+def profile(output: Optional[str] = None, sort: str = 'cumulative',
+            limit: int = 30) -> Iterator[cProfile.Profile]:
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if output is not None:
+            profiler.dump_stats(output)
+        else:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+            sys.stdout.write(stream.getvalue())
@@ -1,63 +1,261 @@
+from __future__ import annotations
+
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
 from datetime import datetime
 from decimal import Decimal
-from typing import List, Optional, Union
+from threading import RLock
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
 from uuid import uuid4, UUID
 
+import metrics
 from car import Car, CarType
 from driver import Driver
-from manager import Manager, singleton
-from map import Location, Map
+from manager import EntityStore, Manager, singleton
+from matching import assign
+from map import SECONDS_PER_TRAFFIC_UNIT, Location, Map, MapSnapshot
 from passenger import Passenger
-from payment import PaymentHandler, PaymentHandlerType, create_handler, CashPayHandler
+from payment import PaymentHandler, PaymentHandlerType, create_handler
+from spatial_index import GridIndex
 from user import UserManager
 
+if TYPE_CHECKING:
+    from trip import Trip
+
+DISPATCH_TIME = metrics.registry.timer('dispatch_round_seconds',
+                                       'Time of OfferManager dispatch rounds by kind')
+OFFERS_DELIVERED = metrics.registry.counter('dispatch_offers_delivered',
+                                            'Offers pushed to drivers')
+OFFERS_RETRACTED = metrics.registry.counter('dispatch_offers_retracted',
+                                            'Offers taken back from drivers')
+BATCH_MATCHED = metrics.registry.histogram('dispatch_batch_matched',
+                                           'Pairs matched by one match_batch round')
+RESYNC_ROUND = metrics.labels(kind='notify_observers')
+PUSH_ROUND = metrics.labels(kind='add_offer')
+BATCH_ROUND = metrics.labels(kind='match_batch')
 
-@dataclass
-class Offer:
-    car_type: CarType
-    departure_point: Location
-    destination_point: Location
-    offer_time: datetime
-    passenger: Passenger
-    payment_handler: PaymentHandler
-    price: Decimal
 
-    def __post_init__(self):
+# Fields are filled in step by step by an OfferBuilder
+class Offer:
+    __slots__ = ('car_type', 'departure_point', 'destination_point', 'offer_time',
+                 'passenger', 'payment_handler', 'price', 'id', 'passenger_id', 'map_version')
+
+    def __init__(self,
+                 car_type: Optional[CarType] = None,
+                 departure_point: Optional[Location] = None,
+                 destination_point: Optional[Location] = None,
+                 offer_time: Optional[datetime] = None,
+                 passenger: Optional[Passenger] = None,
+                 payment_handler: Optional[PaymentHandler] = None,
+                 price: Decimal = Decimal(0.0)):
+        self.car_type = car_type
+        self.departure_point = departure_point
+        self.destination_point = destination_point
+        self.offer_time = offer_time
+        self.passenger = passenger
+        self.payment_handler = payment_handler
+        self.price = price
         self.id = uuid4()
-        self.passenger_id = self.passenger.id
+        self.passenger_id = passenger.id if passenger is not None else None
+        # Version of the map snapshot the price was computed on
+        self.map_version: Optional[int] = None
+
+    def __repr__(self):
+        return f'Offer(id={self.id}, passenger_id={self.passenger_id}, ' \
+               f'departure_point={self.departure_point}, ' \
+               f'destination_point={self.destination_point}, price={self.price}, ' \
+               f'map_version={self.map_version})'
 
 
+# Offers are pushed to ready drivers in range as soon as they are added and
+# retracted from exactly those drivers when they are deleted. A driver that
+# gets ready or moves receives the offers around it. Changes are serialized
+# by a lock, so drivers on other threads (see async_dispatch) are safe.
 @singleton
 class OfferManager:
     def __init__(self):
-        self.offers: List[Offer] = []
-        self.observers: List[Driver] = []
+        self.offers = EntityStore()
+        self.observers = EntityStore()
+        self.dispatch_dist: float = 100
+        # Off in batch mode: offers wait for match_batch instead
+        self.push_offers = True
+        # Also gets every delta sent to a driver, see AsyncDispatcher
+        self.dispatcher: Optional[Any] = None
+        # Ready observers by location, kept current by Driver
+        self.ready_drivers = GridIndex()
+        self.__offer_points = GridIndex()
+        self.__recipients: Dict[UUID, Set[UUID]] = {}  # offer id -> driver ids
+        self.__delivered: Dict[UUID, Set[UUID]] = {}  # driver id -> offer ids
+        self.__lock = RLock()
 
     def add_observer(self, driver: Driver):
-        return Manager.add_element(self.observers, driver)
+        with self.__lock:
+            added = Manager.add_element(self.observers, driver)
+            if added:
+                self.update_driver(driver)
+            return added
 
     def del_observer(self, driver: Driver):
-        return Manager.del_by_id(self.observers, driver.id)
+        with self.__lock:
+            self.ready_drivers.remove(driver)
+            self.__sync(driver, [])
+            self.__delivered.pop(driver.id, None)
+            return Manager.del_by_id(self.observers, driver.id)
+
+    # Called by Driver when its status or location changes
+    def update_driver(self, driver: Driver):
+        with self.__lock:
+            if driver.status == driver.status.READY and \
+                    Manager.find_by_id(self.observers, driver.id) is not None:
+                self.ready_drivers.update(driver, driver.location)
+                if self.push_offers:
+                    self.__sync(driver, self.__offers_in_range(driver, self.dispatch_dist))
+            else:
+                self.ready_drivers.remove(driver)
+                self.__sync(driver, [])
+
+    # Full resync of every driver, only needed after bulk changes
+    def notify_observers(self, max_dist: Optional[float] = None):
+        if max_dist is None:
+            max_dist = self.dispatch_dist
+        started = perf_counter() if metrics.enabled else None
+        with self.__lock:
+            available_offers: Dict[UUID, List[Offer]] = \
+                {driver.id: [] for driver in self.observers}
 
-    def notify_observers(self, max_dist: float = 100):
-        for driver in self.observers:
-            available_offers: List[Offer] = []
             for offer in self.offers:
-                if Map().distance(driver.location, offer.departure_point) < max_dist and \
-                        driver.status == driver.status.READY:
-                    available_offers.append(offer)
-            driver.update(available_offers)
+                for driver in self.__drivers_in_range(offer, max_dist):
+                    available_offers[driver.id].append(offer)
+
+            for driver in self.observers:
+                self.__sync(driver, available_offers[driver.id])
+        if started is not None:
+            DISPATCH_TIME.observe(perf_counter() - started, RESYNC_ROUND)
 
     def del_offer_by_id(self, _id: UUID) -> bool:
-        return Manager.del_by_id(self.offers, _id)
+        return self.claim_offer(_id) is not None
+
+    # Remove the offer and return it. Of concurrent callers exactly one gets
+    # it, the others get None. With a driver the offer is claimed for it:
+    # only while it is ready, and it goes on route in the same step, so a
+    # driver never gets two offers at once.
+    def claim_offer(self, _id: UUID, driver: Optional[Driver] = None) -> Optional[Offer]:
+        with self.__lock:
+            if driver is not None and driver.status != driver.status.READY:
+                return None
+            offer = self.offers.pop(_id)
+            if offer is None:
+                return None
+            if driver is not None:
+                driver.status = driver.status.ON_ROUTE
+            self.__offer_points.remove(offer)
+            for driver_id in self.__recipients.pop(_id, ()):
+                self.__delivered[driver_id].discard(_id)
+                self.__notify(Manager.find_by_id(self.observers, driver_id), [], [_id])
+            return offer
 
     def find_offer_by_id(self, _id: UUID) -> Optional[Offer]:
         return Manager.find_by_id(self.offers, _id)
 
     def add_offer(self, offer: Offer) -> bool:
-        return Manager.add_element(self.offers, offer)
+        started = perf_counter() if metrics.enabled else None
+        with self.__lock:
+            if not Manager.add_element(self.offers, offer):
+                return False
+            self.__offer_points.update(offer, offer.departure_point)
+            if self.push_offers:
+                for driver in self.__drivers_in_range(offer, self.dispatch_dist):
+                    self.__deliver(driver, [offer], [])
+        if started is not None:
+            DISPATCH_TIME.observe(perf_counter() - started, PUSH_ROUND)
+        return True
+
+    # Batch mode: match all pending offers with ready drivers at once so that
+    # the total pickup distance is minimal (greedy above exact_limit pairs)
+    # and start a trip for every matched pair
+    def match_batch(self, max_dist: Optional[float] = None,
+                    exact_limit: int = 300) -> List[Trip]:
+        if max_dist is None:
+            max_dist = self.dispatch_dist
+        started = perf_counter() if metrics.enabled else None
+        with self.__lock:
+            offers = list(self.offers)
+            drivers = list(self.ready_drivers)
+            column = {driver.id: j for j, driver in enumerate(drivers)}
+            edges = [(distance, i, column[driver.id])
+                     for i, offer in enumerate(offers)
+                     for driver, distance in self.__pickup_distances(offer, max_dist)]
+
+            # Drivers go on route here, before the lock is released
+            claimed = []
+            for i, j in assign(edges, len(offers), len(drivers), exact_limit):
+                offer = self.claim_offer(offers[i].id, drivers[j])
+                if offer is not None:
+                    claimed.append((drivers[j], offer))
+
+        if started is not None:
+            DISPATCH_TIME.observe(perf_counter() - started, BATCH_ROUND)
+            BATCH_MATCHED.observe(len(claimed))
+        return [driver.start_trip(offer) for driver, offer in claimed]
+
+    # A way of n cells spans at least n - 1 cells by Manhattan distance, so
+    # only ready drivers that close to an offer are checked by one search
+    def __drivers_in_range(self, offer: Offer, max_dist: float) -> List[Driver]:
+        return [driver for driver, _ in self.__pickup_distances(offer, max_dist)]
+
+    def __pickup_distances(self, offer: Offer, max_dist: float) -> List[Tuple[Driver, int]]:
+        candidates = self.ready_drivers.within(offer.departure_point, max_dist - 1)
+        if not candidates:
+            return []
+        distances = Map().distances_to(offer.departure_point,
+                                       [driver.location for driver in candidates],
+                                       max_dist)
+        return [(driver, distances[driver.location]) for driver in candidates
+                if driver.location in distances]
+
+    def __offers_in_range(self, driver: Driver, max_dist: float) -> List[Offer]:
+        candidates = self.__offer_points.within(driver.location, max_dist - 1)
+        if not candidates:
+            return []
+        distances = Map().distances_from(driver.location,
+                                         [offer.departure_point for offer in candidates],
+                                         max_dist)
+        return [offer for offer in candidates if offer.departure_point in distances]
+
+    # Send the driver only the difference to what it already has
+    def __sync(self, driver: Driver, offers: List[Offer]):
+        delivered = self.__delivered.get(driver.id, set())
+        ids = {offer.id for offer in offers}
+        added = [offer for offer in offers if offer.id not in delivered]
+        removed = [_id for _id in delivered if _id not in ids]
+        if added or removed:
+            self.__deliver(driver, added, removed)
+
+    def __deliver(self, driver: Driver, added: List[Offer], removed: List[UUID]):
+        delivered = self.__delivered.setdefault(driver.id, set())
+        for offer in added:
+            delivered.add(offer.id)
+            self.__recipients.setdefault(offer.id, set()).add(driver.id)
+        for _id in removed:
+            delivered.discard(_id)
+            self.__recipients.get(_id, set()).discard(driver.id)
+        self.__notify(driver, added, removed)
+
+    def __notify(self, driver: Driver, added: List[Offer], removed: List[UUID]):
+        if metrics.enabled:
+            OFFERS_DELIVERED.inc(len(added))
+            OFFERS_RETRACTED.inc(len(removed))
+        driver.update(added, removed)
+        if self.dispatcher is not None:
+            self.dispatcher.publish(driver, added, removed)
+
+
+# One offer to create in bulk, see OfferDirector.make_offers
+class OfferRequest(NamedTuple):
+    passenger: Passenger
+    destination: Location
+    car_type: CarType = CarType.ECONOMY
+    payment_type: PaymentHandlerType = PaymentHandlerType.CashPayHandler
 
 
 class OfferBuilder(ABC):
@@ -73,31 +271,50 @@ class OfferBuilder(ABC):
             raise TypeError('CarInfo should be of type Car or CarInfo!')
 
     def add_departure_point(self):
-        passenger = UserManager().find_passenger_by_id(self.offer.passenger_id)
         # If passenger is not valid
-        if passenger is None:
+        if self.offer.passenger is None:
             raise ValueError('passenger should be valid!')
-        self.offer.departure_point = passenger.location
+        self.offer.departure_point = self.offer.passenger.location
 
     def add_destination_point(self, destination: Location):
-        self.offer.departure_point = destination
+        self.offer.destination_point = destination
 
-    def add_offer_time(self):
-        self.offer.offer_time = datetime.now()
+    def add_offer_time(self, offer_time: Optional[datetime] = None):
+        self.offer.offer_time = offer_time if offer_time is not None else datetime.now()
 
+    # The passenger should be registered in UserManager, OfferDirector checks it
     def add_passenger(self, passenger: Passenger):
+        self.offer.passenger = passenger
         self.offer.passenger_id = passenger.id
 
     def add_payment_process(self,
                             payment_handler_type: PaymentHandlerType =
                             PaymentHandlerType.CashPayHandler):
-        passenger = UserManager().find_passenger_by_id(self.offer.passenger_id)
-        if passenger is None:
+        if self.offer.passenger is None:
             raise ValueError('Passenger should be valid')
-        self.offer.payment_handler = create_handler(passenger, payment_handler_type)
-
+        self.offer.payment_handler = create_handler(self.offer.passenger, payment_handler_type)
+
+    # way is (cells, traffic) of the way between the offer points when it is
+    # already known (see Map.ways_from), otherwise it is searched for on
+    # snapshot, by default the current one
+    def add_price(self, way: Optional[Tuple[int, int]] = None,
+                  snapshot: Optional[MapSnapshot] = None):
+        if snapshot is None:
+            snapshot = Map().snapshot()
+        if way is None:
+            way = Map().way_cost(self.offer.departure_point, self.offer.destination_point,
+                                 snapshot)
+        self.offer.price = self.price(*way)
+        self.offer.map_version = snapshot.version
+
+    # Whether add_price uses the way, otherwise OfferDirector doesn't search
+    # for ways of the batch
+    def uses_ways(self) -> bool:
+        return True
+
+    # Price of a way passing the number of cells with the total traffic
     @abstractmethod
-    def add_price(self):
+    def price(self, cells: int, traffic: int) -> Decimal:
         pass
 
     def create_offer(self) -> Optional[Offer]:
@@ -114,9 +331,8 @@ class DefaultOfferBuilder(OfferBuilder):
         super().__init__()
         self.const_price = const_price
 
-    def add_price(self):
-        dist = Map().distance(self.offer.departure_point, self.offer.destination_point)
-        self.offer.price = self.const_price * dist
+    def price(self, cells: int, traffic: int) -> Decimal:
+        return self.const_price * cells
 
 
 # Price according to traffic at the current time
@@ -125,13 +341,8 @@ class TrafficSensitiveOfferBuilder(OfferBuilder):
         super().__init__()
         self.traffic_coefficient = traffic_coefficient
 
-    def add_price(self):
-        price = Decimal(0)
-        way = Map().find_way(self.offer.departure_point,
-                             self.offer.destination_point)
-        for cell in way:
-            price += Map[cell.y][cell.x] * self.traffic_coefficient
-        self.offer.price = price
+    def price(self, cells: int, traffic: int) -> Decimal:
+        return traffic * self.traffic_coefficient
 
 
 # Price according to time of the trip (can be calculated non-trivially)
@@ -140,66 +351,140 @@ class TimeSensitiveOfferBuilder(OfferBuilder):
         super().__init__()
         self.cost_per_minute = cost_per_minute
 
-    def add_price(self):
-        time = Map().trip_time(self.offer.departure_point, self.offer.destination_point)
-        self.offer.price = time.minute * self.cost_per_minute
+    # With a traffic profile the trip is timed through the traffic of the
+    # offer time, the way measured on the current traffic is not used
+    def uses_ways(self) -> bool:
+        return Map().traffic_profile is None
+
+    def add_price(self, way: Optional[Tuple[int, int]] = None,
+                  snapshot: Optional[MapSnapshot] = None):
+        if Map().traffic_profile is None:
+            super().add_price(way, snapshot)
+            return
+        if snapshot is None:
+            snapshot = Map().snapshot()
+        if self.offer.offer_time is None:
+            self.add_offer_time()
+        seconds = Map().travel_seconds(self.offer.departure_point, self.offer.destination_point,
+                                       self.offer.offer_time, snapshot=snapshot)
+        self.offer.price = seconds // 60 * self.cost_per_minute
+        self.offer.map_version = snapshot.version
+
+    # Whole minutes of the trip, see Map.trip_time
+    def price(self, cells: int, traffic: int) -> Decimal:
+        return traffic * SECONDS_PER_TRAFFIC_UNIT // 60 * self.cost_per_minute
 
 
 @singleton
 class OfferDirector:
-    @staticmethod
-    def make_offer_with_car(passenger: Passenger,
+    # Offers for many requests at once, None for a request that can't be
+    # priced (unreachable destination). Every passenger is looked up once and
+    # the ways are measured by one search per departure point or per
+    # destination, whichever are fewer. Builders that don't use them get
+    # no ways, see OfferBuilder.uses_ways.
+    @classmethod
+    def make_offers(cls, requests: Iterable[OfferRequest],
+                    builder: Optional[OfferBuilder] = None) -> List[Optional[Offer]]:
+        if builder is None:
+            builder = DefaultOfferBuilder()
+        requests = list(requests)
+
+        passengers: Dict[UUID, Passenger] = {}
+        for request in requests:
+            if request.passenger.id not in passengers:
+                passenger = UserManager().find_passenger_by_id(request.passenger.id)
+                if passenger is None:
+                    raise ValueError('passenger should be valid!')
+                passengers[passenger.id] = passenger
+
+        # The whole batch is priced on one snapshot
+        snapshot = Map().snapshot()
+        ways = None
+        if builder.uses_ways():
+            ways = cls.__way_costs([(passengers[request.passenger.id].location,
+                                     request.destination) for request in requests], snapshot)
+
+        offer_time = datetime.now()
+        offers = []
+        for request in requests:
+            passenger = passengers[request.passenger.id]
+            builder.reset()
+            builder.add_passenger(passenger)
+            builder.add_car_type(request.car_type)
+            builder.add_departure_point()
+            builder.add_destination_point(request.destination)
+            builder.add_offer_time(offer_time)
+            builder.add_payment_process(request.payment_type)
+            builder.add_price(ways.get(cls.__key(passenger.location, request.destination),
+                                       (0, 0)) if ways is not None else None, snapshot)
+            offers.append(builder.create_offer())
+        builder.reset()
+        return offers
+
+    @classmethod
+    def make_offer_with_car(cls, passenger: Passenger,
                             car: Car,
                             destination: Location,
-                            builder: OfferBuilder =
-                            DefaultOfferBuilder()) -> Optional[Offer]:
-        builder.add_car_type(car.car_type)
-        builder.add_departure_point()
-        builder.add_destination_point(destination)
-        builder.add_offer_time()
-        builder.add_passenger(passenger)
-        builder.add_payment_process()
-        builder.add_price()
-        return builder.create_offer()
+                            builder: Optional[OfferBuilder] = None) -> Optional[Offer]:
+        return cls.make_offers(
+            [OfferRequest(passenger, destination, car.car_type)], builder)[0]
 
-    @staticmethod
-    def make_offer_without_car(passenger: Passenger,
+    @classmethod
+    def make_offer_without_car(cls, passenger: Passenger,
                                destination: Location,
-                               builder: OfferBuilder =
-                               DefaultOfferBuilder()) -> Optional[Offer]:
-        builder.add_car_type()
-        builder.add_departure_point()
-        builder.add_destination_point(destination)
-        builder.add_offer_time()
-        builder.add_passenger(passenger)
-        builder.add_payment_process()
-        builder.add_price()
-        return builder.create_offer()
+                               builder: Optional[OfferBuilder] = None) -> Optional[Offer]:
+        return cls.make_offers(
+            [OfferRequest(passenger, destination)], builder)[0]
 
-    @staticmethod
-    def make_offer_with_car_with_applepay(passenger: Passenger, car: Car,
+    @classmethod
+    def make_offer_with_car_with_applepay(cls, passenger: Passenger, car: Car,
                                           destination: Location,
-                                          builder: OfferBuilder =
-                                          DefaultOfferBuilder()) -> Optional[Offer]:
-        builder.add_car_type(car.car_type)
-        builder.add_departure_point()
-        builder.add_destination_point(destination)
-        builder.add_offer_time()
-        builder.add_passenger(passenger)
-        builder.add_payment_process(PaymentHandlerType.ApplePayHandler)
-        builder.add_price()
-        return builder.create_offer()
+                                          builder: Optional[OfferBuilder] = None) \
+            -> Optional[Offer]:
+        return cls.make_offers(
+            [OfferRequest(passenger, destination, car.car_type,
+                          PaymentHandlerType.ApplePayHandler)], builder)[0]
+
+    @classmethod
+    def make_offer_without_car_with_applepay(cls, passenger: Passenger,
+                                             destination: Location,
+                                             builder: Optional[OfferBuilder] = None) \
+            -> Optional[Offer]:
+        return cls.make_offers(
+            [OfferRequest(passenger, destination,
+                          payment_type=PaymentHandlerType.ApplePayHandler)], builder)[0]
 
     @staticmethod
-    def make_offer_without_car_with_applepay(passenger: Passenger,
-                                             destination: Location,
-                                             builder: OfferBuilder =
-                                             DefaultOfferBuilder()) -> Optional[Offer]:
-        builder.add_car_type()
-        builder.add_departure_point()
-        builder.add_destination_point(destination)
-        builder.add_offer_time()
-        builder.add_passenger(passenger)
-        builder.add_payment_process(PaymentHandlerType.ApplePayHandler)
-        builder.add_price()
-        return builder.create_offer()
+    def __key(start: Location, end: Location) -> Tuple[int, int, int, int]:
+        return start.x, start.y, end.x, end.y
+
+    # (cells, traffic) of the way for every (start, end) pair. A point with
+    # a single way goes through the route cache instead of a search.
+    @classmethod
+    def __way_costs(cls, pairs: List[Tuple[Location, Location]], snapshot: MapSnapshot) \
+            -> Dict[Tuple[int, int, int, int], Tuple[int, int]]:
+        key = cls.__key
+        by_start: Dict[Location, Set[Location]] = {}
+        by_end: Dict[Location, Set[Location]] = {}
+        for start, end in pairs:
+            by_start.setdefault(start, set()).add(end)
+            by_end.setdefault(end, set()).add(start)
+
+        ways = {}
+        if len(by_start) <= len(by_end):
+            for start, ends in by_start.items():
+                if len(ends) == 1:
+                    end = next(iter(ends))
+                    ways[key(start, end)] = Map().way_cost(start, end, snapshot)
+                    continue
+                for end, way in Map().ways_from(start, ends, snapshot=snapshot).items():
+                    ways[key(start, end)] = way
+        else:
+            for end, starts in by_end.items():
+                if len(starts) == 1:
+                    start = next(iter(starts))
+                    ways[key(start, end)] = Map().way_cost(start, end, snapshot)
+                    continue
+                for start, way in Map().ways_to(end, starts, snapshot=snapshot).items():
+                    ways[key(start, end)] = way
+        return ways
@@ -0,0 +1,137 @@
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from map import Location, Map, MapSnapshot, Route, manhattan_estimate, search_cells
+
+# Shared grid: header, then height * width int8 cells laid out like Map._cells
+HEADER = struct.Struct('<QIIi')  # generation, height, width, min_traffic
+
+# Grid the worker process searches on, attached on its first task:
+# (block, cell view, generation, height, width, min_traffic)
+_grid: Optional[Tuple[shared_memory.SharedMemory, memoryview, int, int, int, int]] = None
+
+
+def _attach(name: str, generation: int) -> Tuple[memoryview, int, int, int]:
+    global _grid
+    if _grid is None or _grid[0].name != name:
+        if _grid is not None:
+            _grid[1].release()
+            _grid[0].close()
+            _grid = None
+        block = shared_memory.SharedMemory(name=name)
+        header = HEADER.unpack_from(block.buf)
+        cells = block.buf[HEADER.size:HEADER.size + header[1] * header[2]].cast('b')
+        _grid = (block, cells) + header
+
+    _, cells, block_generation, height, width, min_traffic = _grid
+    if block_generation != generation:
+        raise RuntimeError(f'Worker grid is generation {block_generation}, '
+                           f'task needs {generation}')
+    return cells, height, width, min_traffic
+
+
+# Runs in a worker: routes as packed cell indexes
+def _find_ways(name: str, generation: int, pairs: List[Tuple[int, int]]) -> List[List[int]]:
+    cells, height, width, min_traffic = _attach(name, generation)
+    return [search_cells(cells, height, width, source, target,
+                         manhattan_estimate(width, min_traffic, target))[0]
+            if source != target else []
+            for source, target in pairs]
+
+
+# Finds batches of routes on Map() in a process pool. A map snapshot is
+# copied once into a new shared memory block that the workers attach to by
+# name, tasks only carry cell indexes. Every task names the block
+# generation it needs, so a whole batch is searched on one snapshot.
+# Routes are the same Route that Map.find_way returns and go to its route
+# cache unless a newer snapshot was published meanwhile.
+class RoutingPool:
+    def __init__(self, processes: Optional[int] = None, chunk_size: int = 64,
+                 min_batch: int = 16):
+        if chunk_size <= 0:
+            raise ValueError('chunk_size should be positive')
+        self.chunk_size = chunk_size
+        # Smaller batches are searched in this process
+        self.min_batch = min_batch
+        self.__executor = ProcessPoolExecutor(processes)
+        self.__lock = Lock()
+        self.__block: Optional[shared_memory.SharedMemory] = None
+        self.__generation = 0
+        self.__stamp: Optional[tuple] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self.__lock:
+            self.__executor.shutdown()
+            if self.__block is not None:
+                self.__block.close()
+                self.__block.unlink()
+                self.__block = None
+
+    # All routes are found on the snapshot current at the call
+    def find_ways(self, pairs: Iterable[Tuple[Location, Location]]) -> List[Route]:
+        pairs = list(pairs)
+        snapshot = Map().snapshot()
+        routes: List[Optional[Route]] = [Map().cached_way(start, end, snapshot)
+                                         for start, end in pairs]
+        missing: Dict[Tuple[int, int, int, int], List[int]] = {}
+        for i, (start, end) in enumerate(pairs):
+            if routes[i] is None:
+                missing.setdefault((start.x, start.y, end.x, end.y), []).append(i)
+
+        if len(missing) < self.min_batch:
+            for indexes in missing.values():
+                route = Map().find_way(*pairs[indexes[0]], snapshot)
+                for i in indexes:
+                    routes[i] = Route(route, route.version)
+            return routes
+
+        width = snapshot.width
+        with self.__lock:
+            self.__publish(snapshot)
+            tasks = [(start_x * width + start_y, end_x * width + end_y)
+                     for start_x, start_y, end_x, end_y in missing]
+            chunks = [tasks[i:i + self.chunk_size]
+                      for i in range(0, len(tasks), self.chunk_size)]
+            found = [route for chunk in self.__executor.map(
+                partial(_find_ways, self.__block.name, self.__generation), chunks)
+                for route in chunk]
+
+        for indexes, cells in zip(missing.values(), found):
+            route = [Location(*divmod(cell, width)) for cell in cells]
+            Map().cache_way(*pairs[indexes[0]], route, snapshot)
+            for i in indexes:
+                routes[i] = Route(route, snapshot.version)
+        return routes
+
+    # Same as Map.distance for every pair
+    def distances(self, pairs: Iterable[Tuple[Location, Location]]) -> List[int]:
+        return [len(route) for route in self.find_ways(pairs)]
+
+    # Copy the snapshot into a new block unless it is the one copied last
+    def __publish(self, snapshot: MapSnapshot):
+        stamp = snapshot.stamp
+        if stamp == self.__stamp and self.__block is not None:
+            return
+
+        size = snapshot.height * snapshot.width
+        block = shared_memory.SharedMemory(create=True, size=HEADER.size + size)
+        self.__generation += 1
+        HEADER.pack_into(block.buf, 0, self.__generation, snapshot.height, snapshot.width,
+                         Map().min_traffic)
+        block.buf[HEADER.size:HEADER.size + size] = snapshot.cells.cast('B')
+
+        if self.__block is not None:
+            self.__block.close()
+            self.__block.unlink()
+        self.__block = block
+        self.__stamp = stamp
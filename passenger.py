@@ -1,11 +1,25 @@
 from decimal import Decimal
 
+from ledger import Ledger, from_cents, to_cents
+from payment import PaymentHandlerType
 from user import User
 
 
+# Balance kept by the Ledger in minor units, seen as Decimal
+def _balance(method: PaymentHandlerType) -> property:
+    def get(self) -> Decimal:
+        return from_cents(Ledger().balance(self.id, method))
+
+    def set(self, value: Decimal):
+        Ledger().set_balance(self.id, method, to_cents(value))
+
+    return property(get, set)
+
+
 class Passenger(User):
+    google_pay_balance = _balance(PaymentHandlerType.GooglePayHandler)
+    apple_pay_balance = _balance(PaymentHandlerType.ApplePayHandler)
+    bank_card_balance = _balance(PaymentHandlerType.BankCardPayHandler)
+
     def __init__(self, login: str, password: str):
         super().__init__(login, password)
-        self.google_pay_balance: Decimal = Decimal(0.0)
-        self.apple_pay_balance: Decimal = Decimal(0.0)
-        self.bank_card_balance: Decimal = Decimal(0.0)
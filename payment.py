@@ -1,11 +1,15 @@
 from __future__ import annotations
 
-from abc import ABC, abstractmethod
 from decimal import Decimal
 from enum import Enum
-from typing import Optional
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Optional
+from uuid import UUID
 
-from passenger import Passenger
+from ledger import Charge, Ledger, to_cents
+
+if TYPE_CHECKING:
+    from passenger import Passenger
 
 
 class PaymentHandlerType(Enum):
@@ -15,90 +19,84 @@ class PaymentHandlerType(Enum):
     CashPayHandler = 4
 
 
-# Create handler with selected type first
-# Cash payment is default
+# Create handler with selected type first, then the other cashless ones in
+# PaymentHandlerType order. Cash payment is always the last one.
+# Handlers are immutable, so one chain is shared by all offers of a passenger.
 def create_handler(passenger: Passenger,
                    payment_handler_type: PaymentHandlerType) -> PaymentHandler:
-    if payment_handler_type == CashPayHandler:
-        handler: PaymentHandler = CashPayHandler(passenger)
-        return handler
-
-    handler = GooglePayHandler(passenger)
-    handler.set_next(ApplePayHandler(passenger))
-    handler.set_next(BankCardPayHandler(passenger))
+    return _chain(passenger.id, payment_handler_type)
 
-    if payment_handler_type == ApplePayHandler:
-        handler = ApplePayHandler(passenger)
-        handler.set_next(GooglePayHandler(passenger))
-        handler.set_next(BankCardPayHandler(passenger))
 
-    if payment_handler_type == BankCardPayHandler:
-        handler = BankCardPayHandler(passenger)
-        handler.set_next(GooglePayHandler(passenger))
-        handler.set_next(ApplePayHandler(passenger))
+@lru_cache(maxsize=65536)
+def _chain(passenger_id: UUID, payment_handler_type: PaymentHandlerType) -> PaymentHandler:
+    handler: PaymentHandler = CashPayHandler(passenger_id)
+    if payment_handler_type == PaymentHandlerType.CashPayHandler:
+        return handler
 
-    handler.set_next(CashPayHandler(passenger))
+    order = [payment_handler_type] + [handler_type for handler_type in PaymentHandlerType
+                                      if handler_type not in (payment_handler_type,
+                                                              PaymentHandlerType.CashPayHandler)]
+    for handler_type in reversed(order):
+        handler = HANDLERS[handler_type](passenger_id, handler)
     return handler
 
 
-class PaymentHandler(ABC):
-    _next_handler: Optional[PaymentHandler] = None
+class PaymentHandler:
+    __slots__ = ('passenger_id', '_next_handler', 'methods')
+    handler_type: PaymentHandlerType
+    message = 'Something went wrong'
 
-    @abstractmethod
-    def __init__(self, passenger: Passenger):
-        self.passenger = passenger
+    def __init__(self, passenger_id: UUID, next_handler: Optional[PaymentHandler] = None):
+        object.__setattr__(self, 'passenger_id', passenger_id)
+        object.__setattr__(self, '_next_handler', next_handler)
+        # Ledger methods this chain tries, in order
+        methods = next_handler.methods if next_handler is not None else ()
+        if self.handler_type != PaymentHandlerType.CashPayHandler:
+            methods = (self.handler_type,) + methods
+        object.__setattr__(self, 'methods', methods)
 
-    def set_next(self, handler: PaymentHandler) -> PaymentHandler:
-        self._next_handler = handler
-        return handler
+    def __setattr__(self, name, value):
+        raise AttributeError('Payment handlers are immutable')
 
-    @abstractmethod
-    def handle(self, price: Decimal) -> str:
-        if self._next_handler:
-            return self._next_handler.handle(price)
+    def charge(self, price: Decimal, reference: Optional[UUID] = None) -> Charge:
+        return Charge(self.passenger_id, to_cents(price), self.methods, reference)
 
-        return 'Something went wrong'
+    # Message about a charge settled by the ledger
+    @staticmethod
+    def result(paid_by: Optional[PaymentHandlerType]) -> str:
+        if paid_by is None:
+            return CashPayHandler.message
+        return HANDLERS[paid_by].message
 
+    def handle(self, price: Decimal, reference: Optional[UUID] = None) -> str:
+        return self.result(Ledger().settle([self.charge(price, reference)])[0])
 
-class GooglePayHandler(PaymentHandler):
-    def __init__(self, passenger: Passenger):
-        super().__init__(passenger)
 
-    def handle(self, price: Decimal) -> str:
-        if self.passenger.google_pay_balance >= price:
-            self.passenger.google_pay_balance -= price
-            return 'Payment by GooglePay went through'
-        else:
-            return super().handle(price)
+class GooglePayHandler(PaymentHandler):
+    __slots__ = ()
+    handler_type = PaymentHandlerType.GooglePayHandler
+    message = 'Payment by GooglePay went through'
 
 
 class ApplePayHandler(PaymentHandler):
-    def __init__(self, passenger: Passenger):
-        super().__init__(passenger)
-
-    def handle(self, price: Decimal) -> str:
-        if self.passenger.apple_pay_balance >= price:
-            self.passenger.apple_pay_balance -= price
-            return 'Payment by ApplePay went through'
-        else:
-            return super().handle(price)
+    __slots__ = ()
+    handler_type = PaymentHandlerType.ApplePayHandler
+    message = 'Payment by ApplePay went through'
 
 
 class BankCardPayHandler(PaymentHandler):
-    def __init__(self, passenger: Passenger):
-        super().__init__(passenger)
-
-    def handle(self, price: Decimal) -> str:
-        if self.passenger.google_pay_balance >= price:
-            self.passenger.bank_card_balance -= price
-            return 'Payment by card went through'
-        else:
-            return super().handle(price)
+    __slots__ = ()
+    handler_type = PaymentHandlerType.BankCardPayHandler
+    message = 'Payment by card went through'
 
 
 class CashPayHandler(PaymentHandler):
-    def __init__(self, passenger: Passenger):
-        super().__init__(passenger)
+    __slots__ = ()
+    handler_type = PaymentHandlerType.CashPayHandler
+    message = 'Passenger have to pay by cash'
+
 
-    def handle(self, price: Decimal) -> str:
-        return 'Passenger have to pay by cash'
+HANDLERS: Dict[PaymentHandlerType, type] = {
+    handler.handler_type: handler
+    for handler in (GooglePayHandler, ApplePayHandler, BankCardPayHandler, CashPayHandler)
+}
@@ -1,12 +1,17 @@
+from __future__ import annotations
+
 import enum
 from datetime import datetime
-from typing import List, Optional
-from uuid import UUID
+from threading import RLock
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Tuple
+from uuid import UUID, uuid4
 
-from manager import singleton, Manager
-from trip import Trip
+from manager import EntityStore, Manager, singleton
 from user import UserManager
 
+if TYPE_CHECKING:
+    from trip import Trip
+
 
 class ReportStatus(enum.Enum):
     PENDING = 0
@@ -15,30 +20,53 @@ class ReportStatus(enum.Enum):
 
 
 class Report:
+    __slots__ = ('id', 'user_id', 'message', 'time_stamp', 'trip', '_status')
+
     def __init__(self, user_id: UUID, message: str, trip: Trip):
+        self.id = uuid4()
         self.user_id = user_id
         self.message = message
         self.time_stamp = datetime.now()
         self.trip = trip
-        self.status = ReportStatus.PENDING
+        self._status = ReportStatus.PENDING
+
+    # ReportManager indexes reports by status
+    @property
+    def status(self) -> ReportStatus:
+        return self._status
+
+    @status.setter
+    def status(self, value: ReportStatus):
+        self._status = value
+        ReportManager().reports.reindex(self)
 
     def __str__(self):
         return f"Time: {self.time_stamp}\nMessage: {self.message}"
 
     def approve(self):
-        user = UserManager().find_user_by_id(self.user_id)
-        if user is not None:
-            user.rating -= 1.0
-        self.status = ReportStatus.APPROVED
+        ReportManager().approve_reports([self])
 
     def decline(self):
-        self.status = ReportStatus.DECLINED
+        ReportManager().decline_reports([self])
 
 
+# Reports indexed by status, user and trip. Pending reports are moderated
+# in the order they were added. Counts per user and status are kept by the
+# index, so abuse checks don't look at the reports themselves.
 @singleton
 class ReportManager:
     def __init__(self):
-        self.reports: List[Report] = []
+        self.reports = EntityStore()
+        self.reports.add_index('status', lambda report: report.status)
+        self.reports.add_index('user', lambda report: report.user_id)
+        self.reports.add_index('trip', lambda report: report.trip.id
+                               if report.trip is not None else None)
+        self.reports.add_index('user_status', lambda report: (report.user_id, report.status))
+        # Approved reports that make a user abusive, None - never
+        self.abuse_threshold: Optional[int] = 3
+        # Rating a user loses for every approved report
+        self.rating_penalty = 1.0
+        self.__lock = RLock()
 
     def del_report_by_id(self, _id: UUID) -> bool:
         return Manager.del_by_id(self.reports, _id)
@@ -48,3 +76,67 @@ class ReportManager:
 
     def add_report(self, report: Report) -> bool:
         return Manager.add_element(self.reports, report)
+
+    def reports_with_status(self, status: ReportStatus) -> List[Report]:
+        return self.reports.find_by('status', status)
+
+    def reports_about_user(self, user_id: UUID) -> List[Report]:
+        return self.reports.find_by('user', user_id)
+
+    def reports_about_trip(self, trip_id: UUID) -> List[Report]:
+        return self.reports.find_by('trip', trip_id)
+
+    # Moderation queue: the oldest pending reports first
+    def pending_reports(self, limit: Optional[int] = None) -> List[Report]:
+        return self.reports.find_by('status', ReportStatus.PENDING, limit)
+
+    def next_pending(self) -> Optional[Report]:
+        return self.reports.find_one_by('status', ReportStatus.PENDING)
+
+    def count_reports(self, user_id: UUID, status: Optional[ReportStatus] = None) -> int:
+        if status is None:
+            return self.reports.count_by('user', user_id)
+        return self.reports.count_by('user_status', (user_id, status))
+
+    def is_abusive(self, user_id: UUID) -> bool:
+        return self.abuse_threshold is not None and \
+            self.count_reports(user_id, ReportStatus.APPROVED) >= self.abuse_threshold
+
+    # Approve the pending ones of reports and lower the rating of every
+    # reported user once by the penalty of all its approved reports.
+    # Returns the reports that were approved.
+    def approve_reports(self, reports: Iterable[Report]) -> List[Report]:
+        with self.__lock:
+            approved = self.__moderate(reports, ReportStatus.APPROVED)
+            penalties: Dict[UUID, float] = {}
+            for report in approved:
+                penalties[report.user_id] = penalties.get(report.user_id, 0.0) + \
+                    self.rating_penalty
+            for user_id, penalty in penalties.items():
+                user = UserManager().find_user_by_id(user_id)
+                if user is not None:
+                    user.rating -= penalty
+            return approved
+
+    def decline_reports(self, reports: Iterable[Report]) -> List[Report]:
+        with self.__lock:
+            return self.__moderate(reports, ReportStatus.DECLINED)
+
+    # Take the oldest pending reports and approve or decline each of them
+    # by decide in one pass. Returns (approved, declined).
+    def moderate_pending(self, decide: Callable[[Report], bool], limit: Optional[int] = None
+                         ) -> Tuple[List[Report], List[Report]]:
+        with self.__lock:
+            approve, decline = [], []
+            for report in self.pending_reports(limit):
+                (approve if decide(report) else decline).append(report)
+            return self.approve_reports(approve), self.decline_reports(decline)
+
+    @staticmethod
+    def __moderate(reports: Iterable[Report], status: ReportStatus) -> List[Report]:
+        moderated = []
+        for report in reports:
+            if report.status == ReportStatus.PENDING:
+                report.status = status
+                moderated.append(report)
+        return moderated
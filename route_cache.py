@@ -0,0 +1,96 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Dict, Hashable, Iterable, NamedTuple, Optional, Sequence, Set, Tuple
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+    size: int
+    max_size: int
+
+
+# Bounded LRU cache of computed routes. Every route remembers its cost and
+# the cells it passes through, so a traffic change in a few cells drops
+# only the routes it can affect. Safe to share between threads.
+class RouteCache:
+    def __init__(self, max_size: int = 4096):
+        if max_size <= 0:
+            raise ValueError('max_size should be positive')
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.__routes: 'OrderedDict[Hashable, Tuple[Tuple, int, Tuple[int, ...]]]' = OrderedDict()
+        self.__by_cell: Dict[int, Set[Hashable]] = {}
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__routes)
+
+    def get(self, key: Hashable) -> Optional[Tuple]:
+        with self.__lock:
+            entry = self.__routes.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.__routes.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, route: Sequence, cost: int = 0, cells: Iterable[int] = ()):
+        cells = tuple(set(cells))
+        with self.__lock:
+            if key in self.__routes:
+                self.__remove(key)
+            self.__routes[key] = (tuple(route), cost, cells)
+            for cell in cells:
+                self.__by_cell.setdefault(cell, set()).add(key)
+            while len(self.__routes) > self.max_size:
+                self.__remove(next(iter(self.__routes)))
+                self.evictions += 1
+
+    # Drop routes passing through any of cells
+    def invalidate_cells(self, cells: Iterable[int]) -> int:
+        with self.__lock:
+            keys = set()
+            for cell in cells:
+                keys.update(self.__by_cell.get(cell, ()))
+            for key in keys:
+                self.__remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    # Drop routes for which predicate(key, cost) is true
+    def invalidate_where(self, predicate: Callable[[Hashable, int], bool]) -> int:
+        with self.__lock:
+            keys = [key for key, (_, cost, _) in self.__routes.items() if predicate(key, cost)]
+            for key in keys:
+                self.__remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self.__lock:
+            self.__routes.clear()
+            self.__by_cell.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.evictions, self.invalidations,
+                         len(self.__routes), self.max_size)
+
+    def __remove(self, key: Hashable):
+        _, _, cells = self.__routes.pop(key)
+        for cell in cells:
+            keys = self.__by_cell[cell]
+            keys.discard(key)
+            if not keys:
+                del self.__by_cell[cell]
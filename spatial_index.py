@@ -0,0 +1,72 @@
+from typing import Any, Dict, Iterator, List, Tuple
+from uuid import UUID
+
+from map import Location
+
+
+# Items with an id bucketed by location into square grid cells, so items
+# near a point are found without looking at the rest
+class GridIndex:
+    def __init__(self, cell_size: int = 16):
+        if cell_size <= 0:
+            raise ValueError('cell_size should be positive')
+        self.cell_size = cell_size
+        self.__buckets: Dict[Tuple[int, int], Dict[UUID, Any]] = {}
+        self.__positions: Dict[UUID, Tuple[int, int]] = {}
+
+    def __len__(self):
+        return len(self.__positions)
+
+    def __contains__(self, item: Any) -> bool:
+        return item.id in self.__positions
+
+    def __iter__(self) -> Iterator[Any]:
+        for bucket in self.__buckets.values():
+            yield from bucket.values()
+
+    def __bucket(self, x: int, y: int) -> Tuple[int, int]:
+        return x // self.cell_size, y // self.cell_size
+
+    # Add item at location or move it there
+    def update(self, item: Any, location: Location):
+        position = self.__positions.get(item.id)
+        if position == (location.x, location.y):
+            return
+        if position is not None:
+            self.remove(item)
+        self.__positions[item.id] = (location.x, location.y)
+        self.__buckets.setdefault(self.__bucket(location.x, location.y), {})[item.id] = item
+
+    def remove(self, item: Any) -> bool:
+        position = self.__positions.pop(item.id, None)
+        if position is None:
+            return False
+        key = self.__bucket(*position)
+        bucket = self.__buckets[key]
+        del bucket[item.id]
+        if not bucket:
+            del self.__buckets[key]
+        return True
+
+    # Items with Manhattan distance to location less than limit
+    def within(self, location: Location, limit: float) -> List[Any]:
+        if limit <= 0:
+            return []
+        reach = int(limit)
+        min_x, min_y = self.__bucket(location.x - reach, location.y - reach)
+        max_x, max_y = self.__bucket(location.x + reach, location.y + reach)
+
+        result = []
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.__buckets):
+            buckets = [bucket for (bx, by), bucket in self.__buckets.items()
+                       if min_x <= bx <= max_x and min_y <= by <= max_y]
+        else:
+            buckets = [self.__buckets[(bx, by)]
+                       for bx in range(min_x, max_x + 1) for by in range(min_y, max_y + 1)
+                       if (bx, by) in self.__buckets]
+        for bucket in buckets:
+            for _id, item in bucket.items():
+                x, y = self.__positions[_id]
+                if abs(x - location.x) + abs(y - location.y) < limit:
+                    result.append(item)
+        return result
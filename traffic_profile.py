@@ -0,0 +1,190 @@
+import math
+import mmap
+import struct
+from datetime import datetime
+from heapq import heappop, heappush
+from random import Random
+from typing import List, Optional, Sequence, Tuple
+
+# Traffic profile file: header, then slices layers of height * width int8
+# cells each (x * width + y), -1 - can't pass, otherwise traffic
+MAGIC = b'TAXITRF\0'
+FORMAT_VERSION = 1
+# magic, version, reserved, height, width, slices, seconds per slice
+HEADER = struct.Struct('<8sHHIIII')
+
+DAY = 24 * 60 * 60
+# Hours of rush peaks in a generated profile
+RUSH_HOURS = (8.5, 18.0)
+
+
+# Precomputed traffic of every cell for every slice_seconds of a period
+# that starts at midnight and repeats, a day by default. All layers lie in
+# one int8 buffer, a loaded profile is memory-mapped.
+class TrafficProfile:
+    def __init__(self, height: int, width: int, slice_seconds: int, cells):
+        cells = memoryview(cells).cast('B').cast('b')
+        if slice_seconds <= 0:
+            raise ValueError('slice_seconds should be positive')
+        if not len(cells) or len(cells) % (height * width):
+            raise ValueError(f'Expected layers of {height * width} cells, got {len(cells)} cells')
+        self.height = height
+        self.width = width
+        self.slice_seconds = slice_seconds
+        self.slices = len(cells) // (height * width)
+        self.cells = cells
+
+    @property
+    def period(self) -> int:
+        return self.slices * self.slice_seconds
+
+    # One layer of height * width values per slice, the first one from midnight
+    @classmethod
+    def from_layers(cls, height: int, width: int, slice_seconds: int,
+                    layers: Sequence[Sequence[int]]) -> 'TrafficProfile':
+        buffer = bytearray()
+        for layer in layers:
+            if len(layer) != height * width:
+                raise ValueError(f'Layer should hold {height * width} cells')
+            buffer += bytes(value & 0xFF for value in layer)
+        return cls(height, width, slice_seconds, buffer)
+
+    # Profile of a day: random traffic of every free cell scaled by the time
+    # of day, half of it at night, all of it from 6 to 22 and up to one and a
+    # half at RUSH_HOURS. Every layer is one bytes.translate of the base.
+    @classmethod
+    def generate(cls, cells: Sequence[int], height: int, width: int,
+                 slice_minutes: int = 15, min_traffic: int = 0, max_traffic: int = 10,
+                 seed: Optional[int] = None) -> 'TrafficProfile':
+        slice_seconds = slice_minutes * 60
+        if DAY % slice_seconds:
+            raise ValueError('slice_minutes should divide a day')
+        rng = Random(seed)
+        base = bytes(0xFF if cell == -1 else rng.randint(min_traffic, max_traffic)
+                     for cell in cells)
+
+        buffer = bytearray()
+        for index in range(DAY // slice_seconds):
+            hour = (index + 0.5) * slice_seconds / 3600
+            daytime = 1 / (1 + math.exp(12 - 2 * hour)) - 1 / (1 + math.exp(44 - 2 * hour))
+            rush = sum(math.exp(-((hour - peak) / 1.5) ** 2) for peak in RUSH_HOURS)
+            factor = 0.5 + 0.5 * daytime + 0.5 * rush
+            table = bytes(min(max_traffic, max(min_traffic, round(value * factor)))
+                          for value in range(255)) + b'\xff'
+            buffer += base.translate(table)
+        return cls(height, width, slice_seconds, buffer)
+
+    @classmethod
+    def load(cls, file_name: str) -> 'TrafficProfile':
+        with open(file_name, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buffer) < HEADER.size:
+            raise ValueError(f'{file_name} is too short for a traffic profile header')
+        magic, version, _, height, width, slices, slice_seconds = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError(f'{file_name} is not a traffic profile')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported traffic profile version {version}')
+        if len(buffer) != HEADER.size + slices * height * width:
+            raise ValueError(f'{file_name} should hold {slices} layers of {height * width} cells')
+        return cls(height, width, slice_seconds, memoryview(buffer)[HEADER.size:])
+
+    def save(self, file_name: str):
+        with open(file_name, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, self.height, self.width,
+                                   self.slices, self.slice_seconds))
+            file.write(self.cells.cast('B'))
+
+    def slice_index(self, seconds: float) -> int:
+        return int(seconds // self.slice_seconds) % self.slices
+
+    def layer(self, index: int) -> memoryview:
+        size = self.height * self.width
+        return self.cells[index * size:(index + 1) * size]
+
+    def layer_at(self, moment: datetime) -> memoryview:
+        return self.layer(self.slice_index(seconds_of_day(moment)))
+
+    # Moment the cell entered at seconds is left. A cell takes traffic *
+    # seconds_per_unit at the traffic of the slice, a share of it passed in
+    # one slice is kept when the next one begins. So leaving later never
+    # means entering later, and Dijkstra on arrival times stays exact.
+    def traverse(self, cell: int, seconds: float, seconds_per_unit: int) -> float:
+        cells, size, slice_seconds = self.cells, self.height * self.width, self.slice_seconds
+        remaining = 1.0
+        while True:
+            index = int(seconds // slice_seconds)
+            value = cells[(index % self.slices) * size + cell]
+            if value <= 0:
+                return seconds
+            needed = remaining * value * seconds_per_unit
+            end = (index + 1) * slice_seconds
+            if seconds + needed <= end:
+                return seconds + needed
+            remaining -= (end - seconds) / (value * seconds_per_unit)
+            seconds = end
+
+
+def seconds_of_day(moment: datetime) -> float:
+    return moment.hour * 3600 + moment.minute * 60 + moment.second + moment.microsecond / 1e6
+
+
+# Dijkstra on arrival times from source departing at departure seconds of
+# the profile period. Like Map.trip_time the source cell is paid too.
+# Among ways arriving at the same time the one with fewer cells is chosen.
+# Returns the route cell indices (empty if target is unreachable) and the
+# arrival in the same seconds.
+def search_time_dependent(profile: TrafficProfile, source: int, target: int,
+                          departure: float, seconds_per_unit: int) -> Tuple[List[int], float]:
+    height, width = profile.height, profile.width
+    size, slice_seconds, slices = height * width, profile.slice_seconds, profile.slices
+    cells = profile.cells
+
+    inf = float('inf')
+    arrival = [inf] * size
+    length = [0] * size
+    parent = [-1] * size
+    settled = bytearray(size)
+
+    arrival[source] = profile.traverse(source, departure, seconds_per_unit)
+    heap = [(arrival[source], 0, source)]
+    while heap:
+        now, hops, point = heappop(heap)
+        if settled[point]:
+            continue
+        settled[point] = 1
+        if point == target:
+            break
+
+        index = int(now // slice_seconds)
+        layer = (index % slices) * size
+        slice_end = (index + 1) * slice_seconds
+        x, y = divmod(point, width)
+        hops += 1
+        for xx, yy in ((x - 1, y), (x, y - 1), (x + 1, y), (x, y + 1)):
+            if not (0 <= xx < height and 0 <= yy < width):
+                continue
+            cell = xx * width + yy
+            if settled[cell]:
+                continue
+            value = cells[layer + cell]
+            if value == -1:
+                continue
+            leave = now + value * seconds_per_unit
+            if leave > slice_end:
+                leave = profile.traverse(cell, now, seconds_per_unit)
+            if leave < arrival[cell] or (leave == arrival[cell] and hops < length[cell]):
+                arrival[cell] = leave
+                length[cell] = hops
+                parent[cell] = point
+                heappush(heap, (leave, hops, cell))
+
+    if not settled[target]:
+        return [], departure
+    route = []
+    point = target
+    while point != -1:
+        route.append(point)
+        point = parent[point]
+    route.reverse()
+    return route, arrival[target]
@@ -1,32 +1,62 @@
 from abc import ABC, abstractmethod
 from datetime import datetime
 from decimal import Decimal
-from typing import List, Optional
+from threading import Lock
+from typing import Callable, Iterable, List, Optional, Set
 from uuid import uuid4, UUID
 
+import metrics
 from driver import Driver, Status
-from manager import Manager, singleton
+from ledger import Ledger
+from manager import EntityStore, Manager, singleton
 from map import Map
 from offer import Offer
+from payment import CashPayHandler, PaymentHandler
 from report import Report, ReportManager
+from trip_archive import ArchivedTrip, TripArchive
 from user import UserManager
 
+TRANSITIONS = metrics.registry.counter('trip_transitions', 'Trip state changes')
+
 
 class Trip:
+    __slots__ = ('arrival_time', 'departure_time', 'driver_id', 'driver_liked',
+                 'estimated_trip_time', 'id', 'passenger_id', 'passenger_liked',
+                 'payment_handler', 'price', 'offer_id', 'pickup_time', 'map_version', '_state')
+
     def __init__(self, driver: Driver, offer: Offer):
         self.arrival_time = None
-        self.departure_time = datetime.now()
+        self.departure_time = TripManager().clock()
         self.driver_id = driver.id
         self.driver_liked = False
+        snapshot = Map().snapshot()
         self.estimated_trip_time = Map().trip_time(offer.departure_point,
-                                                   offer.destination_point)
+                                                   offer.destination_point,
+                                                   departure=self.departure_time,
+                                                   snapshot=snapshot)
+        # Version of the map snapshot of the estimate
+        self.map_version = snapshot.version
         self.id = uuid4()
         self.passenger_id = offer.passenger_id
         self.passenger_liked = False
         self.payment_handler = offer.payment_handler
         self.price: Decimal = offer.price
         self.offer_id = offer.id
-        self.state: ITripState = WaitingState()
+        self.pickup_time: Optional[datetime] = None
+        self._state: ITripState = WaitingState()
+
+    # TripManager indexes trips by the type of their state
+    @property
+    def state(self) -> 'ITripState':
+        return self._state
+
+    @state.setter
+    def state(self, value: 'ITripState'):
+        if metrics.enabled:
+            TRANSITIONS.inc(1, metrics.labels(from_state=type(self._state).__name__,
+                                              to_state=type(value).__name__))
+        self._state = value
+        TripManager().trips.reindex(self)
 
     def next_state(self):
         self.state.next_state(self)
@@ -34,6 +64,11 @@ class Trip:
     def final_state(self):
         self.state.final_state(self)
 
+    # Called by the states once the trip is over
+    def finish(self):
+        self.state = FinishedState()
+        TripManager().archive_trip(self)
+
     def driver_report(self, msg: str) -> Report:
         return Report(self.driver_id, msg, self)
 
@@ -53,10 +88,19 @@ class Trip:
                 passenger.rating += 0.1
 
 
+# Trips in progress. With an archive set, finished trips are written to it
+# and dropped from memory, see trip_archive. clock is the time source of
+# trips and their states, see lifecycle.
 @singleton
 class TripManager:
     def __init__(self):
-        self.trips: List[Trip] = []
+        self.trips = EntityStore()
+        self.trips.add_index('state', lambda trip: type(trip.state))
+        self.archive: Optional[TripArchive] = None
+        self.clock: Callable[[], datetime] = datetime.now
+        # Ids of trips being paid for, see claim_payment
+        self.__paying: Set[UUID] = set()
+        self.__paying_lock = Lock()
 
     def del_trip_by_id(self, _id: UUID) -> bool:
         return Manager.del_by_id(self.trips, _id)
@@ -67,6 +111,59 @@ class TripManager:
     def add_trip(self, trip: Trip) -> bool:
         return Manager.add_element(self.trips, trip)
 
+    def trips_in_state(self, state: type) -> List[Trip]:
+        return self.trips.find_by('state', state)
+
+    def archive_trip(self, trip: Trip) -> bool:
+        if self.archive is None:
+            return False
+        self.archive.append(trip)
+        Manager.del_by_id(self.trips, trip.id)
+        return True
+
+    # Only one payment of a trip waiting for it may go on at a time, the
+    # one that claimed it. False if the trip doesn't wait for payment or
+    # is already being paid for.
+    def claim_payment(self, trip: Trip) -> bool:
+        with self.__paying_lock:
+            if not isinstance(trip.state, PaymentState) or trip.id in self.__paying:
+                return False
+            self.__paying.add(trip.id)
+            return True
+
+    def release_payment(self, trip: Trip):
+        with self.__paying_lock:
+            self.__paying.discard(trip.id)
+
+    # Pay for all trips waiting for payment in one pass over the ledger and
+    # finish them. Trips being paid for elsewhere are skipped, and so are
+    # trips whose passenger or driver is gone: they stay waiting for
+    # payment and are never charged without being finished. Returns the
+    # payment messages in the order of the trips paid.
+    def settle_trips(self, trips: Iterable[Trip]) -> List[str]:
+        claimed = [trip for trip in trips if self.claim_payment(trip)]
+        try:
+            drivers = {}
+            valid = []
+            for trip in claimed:
+                if trip.driver_id not in drivers:
+                    drivers[trip.driver_id] = UserManager().find_driver_by_id(trip.driver_id)
+                if drivers[trip.driver_id] is not None and \
+                        UserManager().find_passenger_by_id(trip.passenger_id) is not None:
+                    valid.append(trip)
+            paid_by = Ledger().settle(trip.payment_handler.charge(trip.price, trip.id)
+                                      for trip in valid)
+            messages = [PaymentHandler.result(method) for method in paid_by]
+            for trip in valid:
+                PaymentState.paid(trip, drivers[trip.driver_id])
+            return messages
+        finally:
+            for trip in claimed:
+                self.release_payment(trip)
+
+    def find_archived_trip(self, _id: UUID) -> Optional[ArchivedTrip]:
+        return self.archive.find(_id) if self.archive is not None else None
+
 
 class ITripState(ABC):
     @abstractmethod
@@ -83,31 +180,38 @@ class WaitingState(ITripState):
         self.wait_price = Decimal(10.5)
 
     def next_state(self, trip: Trip):
-        passed_time = int((datetime.now() - trip.departure_time).total_seconds() / 60)
+        self.pick_up(trip, TripManager().clock())
+
+    # Charge for the wait and set off
+    def pick_up(self, trip: Trip, now: datetime):
+        passed_time = int((now - trip.departure_time).total_seconds() / 60)
         trip.price += Decimal(self.wait_price * passed_time)
+        trip.pickup_time = now
         trip.state = RidingState()
 
     def final_state(self, trip: Trip):
         passenger = UserManager().find_passenger_by_id(trip.passenger_id)
         if passenger is None:
             raise ValueError('Passenger should be valid')
-        if trip.payment_handler.handle(
-                trip.price) == 'Passenger have to pay by cash':
+        if trip.payment_handler.handle(trip.price, trip.id) == CashPayHandler.message:
             ReportManager().add_report(trip.passenger_report('No payment'))
-        trip.state = FinishedState()
+        trip.finish()
 
 
 class RidingState(ITripState):
     def next_state(self, trip: Trip):
-        trip.arrival_time = datetime.now()
+        self.arrive(trip, TripManager().clock())
+
+    def arrive(self, trip: Trip, now: datetime):
+        trip.arrival_time = now
         trip.state = PaymentState()
 
     def final_state(self, trip: Trip):
         passenger = UserManager().find_passenger_by_id(trip.passenger_id)
         if passenger is None:
             raise ValueError('Passenger should be valid')
-        trip.payment_handler.handle(trip.price)
-        trip.state = FinishedState()
+        trip.payment_handler.handle(trip.price, trip.id)
+        trip.finish()
 
 
 class PaymentState(ITripState):
@@ -115,12 +219,21 @@ class PaymentState(ITripState):
         passenger = UserManager().find_passenger_by_id(trip.passenger_id)
         if passenger is None:
             raise ValueError('Passenger should be valid')
-        print(trip.payment_handler.handle(trip.price))
-        driver = UserManager().find_driver_by_id(trip.driver_id)
+        if not TripManager().claim_payment(trip):
+            return
+        try:
+            print(trip.payment_handler.handle(trip.price, trip.id))
+            self.paid(trip, UserManager().find_driver_by_id(trip.driver_id))
+        finally:
+            TripManager().release_payment(trip)
+
+    # Rest of the transition once the ledger settled the trip
+    @staticmethod
+    def paid(trip: Trip, driver: Optional[Driver]):
         if driver is None:
             raise ValueError('Driver should be valid')
         driver.status = Status.READY
-        trip.state = FinishedState()
+        trip.finish()
 
     def final_state(self, trip: Trip):
         self.next_state(trip)
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import struct
+from datetime import datetime, time
+from decimal import Decimal
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from uuid import UUID
+
+if TYPE_CHECKING:
+    from trip import Trip
+
+# Index of a sealed segment: entries sorted by trip id
+INDEX_ENTRY = struct.Struct('<16sQI')  # trip id, offset in the log, record length
+
+
+# What is kept of a finished trip: no payment handler, state or user objects
+class ArchivedTrip(NamedTuple):
+    id: UUID
+    driver_id: UUID
+    passenger_id: UUID
+    offer_id: UUID
+    departure_time: datetime
+    arrival_time: Optional[datetime]
+    estimated_trip_time: time
+    price: Decimal
+    driver_liked: bool
+    passenger_liked: bool
+    map_version: Optional[int] = None
+    pickup_time: Optional[datetime] = None
+
+    @staticmethod
+    def from_trip(trip: Trip) -> ArchivedTrip:
+        return ArchivedTrip(trip.id, trip.driver_id, trip.passenger_id, trip.offer_id,
+                            trip.departure_time, trip.arrival_time, trip.estimated_trip_time,
+                            trip.price, trip.driver_liked, trip.passenger_liked,
+                            trip.map_version, trip.pickup_time)
+
+    def encode(self) -> bytes:
+        return json.dumps([str(self.id), str(self.driver_id), str(self.passenger_id),
+                           str(self.offer_id), self.departure_time.isoformat(),
+                           self.arrival_time.isoformat() if self.arrival_time else None,
+                           self.estimated_trip_time.isoformat(), str(self.price),
+                           self.driver_liked, self.passenger_liked, self.map_version,
+                           self.pickup_time.isoformat() if self.pickup_time else None],
+                          separators=(',', ':')).encode() + b'\n'
+
+    # Records written before map_version or pickup_time were kept end
+    # earlier, the missing fields are None
+    @staticmethod
+    def decode(line: bytes) -> ArchivedTrip:
+        (_id, driver_id, passenger_id, offer_id, departure_time, arrival_time,
+         estimated_trip_time, price, driver_liked, passenger_liked, *rest) = json.loads(line)
+        return ArchivedTrip(UUID(_id), UUID(driver_id), UUID(passenger_id), UUID(offer_id),
+                            datetime.fromisoformat(departure_time),
+                            datetime.fromisoformat(arrival_time) if arrival_time else None,
+                            time.fromisoformat(estimated_trip_time), Decimal(price),
+                            driver_liked, passenger_liked, rest[0] if rest else None,
+                            datetime.fromisoformat(rest[1]) if len(rest) > 1 and rest[1]
+                            else None)
+
+
+# Every finished trip in the order of archiving, one segment in memory at a time
+def read_segment(file_name: str) -> Iterator[ArchivedTrip]:
+    with open(file_name, 'rb') as file:
+        for line in file:
+            if line.endswith(b'\n'):
+                yield ArchivedTrip.decode(line)
+
+
+# Append-only log of finished trips in a directory. Records go to the
+# active segment, one JSON line each. Once it grows past segment_size it is
+# sealed: an index sorted by trip id is written next to it and a new
+# segment is started. Only the ids of the active segment are held in
+# memory, older ones are found by binary search in the mapped indexes.
+class TripArchive:
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024,
+                 fsync: bool = False):
+        if segment_size <= 0:
+            raise ValueError('segment_size should be positive')
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.__lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        numbers = sorted(int(name[:-4]) for name in os.listdir(directory)
+                         if name.endswith('.log') and name[:-4].isdigit())
+        self.__sealed: List[int] = [number for number in numbers
+                                    if os.path.exists(self.__index_name(number))]
+        unsealed = [number for number in numbers if number not in self.__sealed]
+        if len(unsealed) > 1 or (unsealed and unsealed[0] != numbers[-1]):
+            raise ValueError(f'{directory} has unsealed segments before the last one')
+
+        self.__number = unsealed[0] if unsealed else (numbers[-1] + 1 if numbers else 1)
+        self.__entries: Dict[UUID, Tuple[int, int]] = self.__recover(self.__number)
+        self.__log = open(self.__log_name(self.__number), 'ab')
+        self.__indexes: Dict[int, mmap.mmap] = {}
+
+    def __len__(self):
+        return len(self.__entries) + sum(os.path.getsize(self.__index_name(number))
+                                         // INDEX_ENTRY.size for number in self.__sealed)
+
+    def close(self):
+        with self.__lock:
+            self.__log.close()
+            for index in self.__indexes.values():
+                index.close()
+            self.__indexes.clear()
+
+    def append(self, trip: Trip):
+        record = ArchivedTrip.from_trip(trip).encode()
+        with self.__lock:
+            offset = self.__log.tell()
+            self.__log.write(record)
+            self.__log.flush()
+            if self.fsync:
+                os.fsync(self.__log.fileno())
+            self.__entries[trip.id] = (offset, len(record))
+            if offset + len(record) >= self.segment_size:
+                self.__seal()
+
+    def find(self, _id: UUID) -> Optional[ArchivedTrip]:
+        with self.__lock:
+            entry = self.__entries.get(_id)
+            if entry is not None:
+                return self.__read(self.__number, *entry)
+            for number in reversed(self.__sealed):
+                entry = self.__lookup(number, _id)
+                if entry is not None:
+                    return self.__read(number, *entry)
+        return None
+
+    # Streams the whole history, oldest first
+    def __iter__(self) -> Iterator[ArchivedTrip]:
+        with self.__lock:
+            numbers = self.__sealed + [self.__number]
+        for number in numbers:
+            yield from read_segment(self.__log_name(number))
+
+    def __log_name(self, number: int) -> str:
+        return os.path.join(self.directory, f'{number:08d}.log')
+
+    def __index_name(self, number: int) -> str:
+        return os.path.join(self.directory, f'{number:08d}.idx')
+
+    # Ids of the active segment. A record cut off by a crash is dropped.
+    def __recover(self, number: int) -> Dict[UUID, Tuple[int, int]]:
+        entries: Dict[UUID, Tuple[int, int]] = {}
+        if not os.path.exists(self.__log_name(number)):
+            return entries
+        offset = 0
+        with open(self.__log_name(number), 'rb+') as file:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                entries[ArchivedTrip.decode(line).id] = (offset, len(line))
+                offset += len(line)
+            file.truncate(offset)
+        return entries
+
+    def __seal(self):
+        self.__log.close()
+        entries = sorted((_id.bytes, offset, length)
+                         for _id, (offset, length) in self.__entries.items())
+        temporary = self.__index_name(self.__number) + '.tmp'
+        with open(temporary, 'wb') as file:
+            for entry in entries:
+                file.write(INDEX_ENTRY.pack(*entry))
+        os.replace(temporary, self.__index_name(self.__number))
+
+        self.__sealed.append(self.__number)
+        self.__number += 1
+        self.__entries = {}
+        self.__log = open(self.__log_name(self.__number), 'ab')
+
+    def __lookup(self, number: int, _id: UUID) -> Optional[Tuple[int, int]]:
+        index = self.__indexes.get(number)
+        if index is None:
+            with open(self.__index_name(number), 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return None
+                index = self.__indexes[number] = mmap.mmap(file.fileno(), 0,
+                                                           access=mmap.ACCESS_READ)
+        key = _id.bytes
+        low, high = 0, len(index) // INDEX_ENTRY.size
+        while low < high:
+            middle = (low + high) // 2
+            entry_id, offset, length = INDEX_ENTRY.unpack_from(index, middle * INDEX_ENTRY.size)
+            if entry_id == key:
+                return offset, length
+            if entry_id < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def __read(self, number: int, offset: int, length: int) -> ArchivedTrip:
+        with open(self.__log_name(number), 'rb') as file:
+            file.seek(offset)
+            return ArchivedTrip.decode(file.read(length))
@@ -1,12 +1,17 @@
+from __future__ import annotations
+
 import random
 from random import randint
-from typing import List, Optional
+from typing import TYPE_CHECKING, List, Optional
 from uuid import uuid4, UUID
 
-from driver import Driver
-from manager import Manager, singleton
+from manager import EntityStore, Manager, singleton
 from map import Location, Map
-from passenger import Passenger
+
+# driver and passenger subclass User, so they are imported where used
+if TYPE_CHECKING:
+    from driver import Driver, Status
+    from passenger import Passenger
 
 
 class User:
@@ -49,6 +54,11 @@ class User:
     def location(self, value: Location):
         if 0 <= value.x <= Map().max_x and 0 <= value.y <= Map().max_y:
             self.__location = value
+            self._location_changed()
+
+    # Hook for subclasses that index users by location
+    def _location_changed(self):
+        pass
 
     def __str__(self):
         return f"{self.login}"
@@ -57,7 +67,11 @@ class User:
 @singleton
 class UserManager:
     def __init__(self):
-        self.users: List[User] = []
+        self.users = EntityStore()
+        self.users.add_index('login', lambda user: user.login, unique=True)
+        self.users.add_index('role', type)
+        # Only drivers have a status, everybody else is under None
+        self.users.add_index('status', lambda user: getattr(user, 'status', None))
 
     def del_user_by_id(self, _id: UUID) -> bool:
         return Manager.del_by_id(self.users, _id)
@@ -66,19 +80,40 @@ class UserManager:
         return Manager.find_by_id(self.users, _id)
 
     def find_driver_by_id(self, _id: UUID) -> Optional[Driver]:
+        from driver import Driver
         driver = Manager.find_by_id(self.users, _id)
         if isinstance(driver, Driver):
             return driver
         return None
 
     def find_passenger_by_id(self, _id: UUID) -> Optional[Passenger]:
+        from passenger import Passenger
         passenger = Manager.find_by_id(self.users, _id)
         if isinstance(passenger, Passenger):
             return passenger
         return None
 
+    def find_user_by_login(self, login: str) -> Optional[User]:
+        return self.users.find_one_by('login', login)
+
+    def drivers(self) -> List[Driver]:
+        from driver import Driver
+        return self.users.find_by('role', Driver)
+
+    def passengers(self) -> List[Passenger]:
+        from passenger import Passenger
+        return self.users.find_by('role', Passenger)
+
+    def drivers_with_status(self, status: Status) -> List[Driver]:
+        return self.users.find_by('status', status)
+
+    # Called by Driver when its status changes
+    def update_user(self, user: User):
+        self.users.reindex(user)
+
     def add_user(self, user: User) -> bool:
-        for user in self.users:
-            if user.login == user.login:
-                raise ValueError("Login is already used by another user")
+        if user in self.users:
+            return False
+        if self.find_user_by_login(user.login) is not None:
+            raise ValueError("Login is already used by another user")
         return Manager.add_element(self.users, user)